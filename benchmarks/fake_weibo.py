@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+A local stand-in for api.weibo.com.
+
+Serves the APIs used by tornado_weibo with made up data, every response is
+delayed by ``--latency`` milliseconds and fails with ``500`` with a
+probability of ``--error_rate``. Point tornado_weibo to it with the
+``weibo_api_url`` setting::
+
+    python benchmarks/fake_weibo.py --port=8900 --latency=20
+"""
+import random
+import logging
+import tornado.ioloop
+import tornado.web
+from tornado.options import define, options
+from tornado import gen
+
+
+def _user(uid):
+    uid = int(uid)
+    return {
+        "id": uid,
+        "idstr": str(uid),
+        "screen_name": "user%d" % uid,
+        "name": "user%d" % uid,
+        "location": "Beijing",
+        "url": "http://weibo.com/u/%d" % uid,
+        "profile_image_url": "http://tp1.sinaimg.cn/%d/50/0/1" % uid,
+        "description": "A user made up by the stand-in server",
+        "followers_count": uid % 1000,
+        "friends_count": uid % 100,
+        "statuses_count": uid % 10000,
+    }
+
+
+def _status(id, uid):
+    return {
+        "id": id,
+        "idstr": str(id),
+        "mid": str(id),
+        "created_at": "Tue May 31 17:46:55 +0800 2011",
+        "text": "status %d " % id + "x" * 100,
+        "source": "tornado_weibo",
+        "reposts_count": id % 10,
+        "comments_count": id % 7,
+        "user": _user(uid),
+    }
+
+
+class FakeHandler(tornado.web.RequestHandler):
+
+    @gen.coroutine
+    def prepare(self):
+        latency = self.settings["latency"]
+        if latency:
+            yield gen.sleep(latency / 1000.0)
+        if random.random() < self.settings["error_rate"]:
+            self.set_status(500)
+            self.finish({"error": "made up error", "error_code": 10001})
+
+    def check_xsrf_cookie(self):
+        pass
+
+
+class AccessTokenHandler(FakeHandler):
+
+    def post(self):
+        code = self.get_argument("code")
+        self.write({
+            "access_token": "token-" + code,
+            "expires_in": 157679999,
+            "uid": str(abs(hash(code)) % 10 ** 10),
+        })
+
+
+class GetUidHandler(FakeHandler):
+
+    def get(self):
+        token = self.get_argument("access_token")
+        self.write({"uid": abs(hash(token)) % 10 ** 10})
+
+
+class UsersShowHandler(FakeHandler):
+
+    def get(self):
+        self.write(_user(self.get_argument("uid")))
+
+
+class TimelineHandler(FakeHandler):
+
+    def get(self):
+        count = min(int(self.get_argument("count", 20)), 200)
+        max_id = int(self.get_argument("max_id", self.settings["newest_id"]))
+        since_id = int(self.get_argument("since_id", 0))
+        uid = int(self.get_argument("uid", 1))
+        ids = range(max_id, max(max_id - count, since_id), -1)
+        self.write({
+            "statuses": [_status(id, uid) for id in ids],
+            "total_number": self.settings["newest_id"],
+        })
+
+
+@tornado.web.stream_request_body
+class UploadHandler(FakeHandler):
+
+    def prepare(self):
+        self.received = 0
+        return FakeHandler.prepare(self)
+
+    def data_received(self, chunk):
+        self.received += len(chunk)
+
+    def post(self):
+        self.write(dict(_status(self.settings["newest_id"] + 1, 1),
+                        received=self.received))
+
+
+def make_app(latency=0, error_rate=0.0, quiet=False):
+    settings = {}
+    if quiet:
+        settings["log_function"] = lambda handler: None
+    return tornado.web.Application([
+        (r"/oauth2/access_token", AccessTokenHandler),
+        (r"/2/account/get_uid\.json", GetUidHandler),
+        (r"/2/users/show\.json", UsersShowHandler),
+        (r"/2/statuses/(?:user|home)_timeline\.json", TimelineHandler),
+        (r"/2/statuses/upload\.json", UploadHandler),
+    ], latency=latency, error_rate=error_rate, newest_id=100000, **settings)
+
+
+def serve(port, latency=0, error_rate=0.0, quiet=False):
+    app = make_app(latency, error_rate, quiet)
+    app.listen(port, address="127.0.0.1", max_body_size=64 * 1024 * 1024)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    define("port", default=8900, help="port to listen on")
+    define("latency", default=0, help="delay of every response in milliseconds")
+    define("error_rate", default=0.0, help="probability of a 500 response")
+    options.parse_command_line()
+    logging.info("Serving the Weibo stand-in on port %d", options.port)
+    serve(options.port, options.latency, options.error_rate)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Benchmarks of tornado_weibo against the local Weibo stand-in server.
+
+Starts ``fake_weibo.py`` in a child process and measures login flows per
+second, ``weibo_request`` throughput, latency percentiles and the memory
+used by uploads::
+
+    python benchmarks/run.py --requests=2000 --concurrency=50 --latency=10
+"""
+import os
+import sys
+import time
+import socket
+import multiprocessing
+from tornado.ioloop import IOLoop
+from tornado.options import define, options
+from tornado import gen
+from tornado import locks
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import fake_weibo
+from tornado_weibo.auth import WeiboClient
+from tornado_weibo.cache import ResponseCache, RequestCoalescer
+
+define("port", default=8900, help="port of the stand-in server")
+define("requests", default=1000, help="requests per benchmark")
+define("concurrency", default=20, help="requests in flight at the same time")
+define("latency", default=0, help="latency of the stand-in in milliseconds")
+define("error_rate", default=0.0, help="error rate of the stand-in")
+define("upload_size", default=8 * 1024 * 1024, help="bytes of the upload")
+define("cache", default=False, help="enable the response cache and "
+                                   "request coalescing")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+@gen.coroutine
+def run_concurrently(make_request, requests, concurrency):
+    """
+    Run ``make_request(i)`` ``requests`` times, ``concurrency`` at a time.
+    Returns the elapsed seconds, the latencies and the number of failures.
+    """
+    semaphore = locks.Semaphore(concurrency)
+    latencies = []
+    failures = [0]
+
+    @gen.coroutine
+    def one(i):
+        with (yield semaphore.acquire()):
+            start = time.time()
+            result = yield make_request(i)
+            latencies.append(time.time() - start)
+            if result is None:
+                failures[0] += 1
+
+    start = time.time()
+    yield [one(i) for i in range(requests)]
+    raise gen.Return((time.time() - start, latencies, failures[0]))
+
+
+def report(name, elapsed, latencies, failures):
+    print("%-16s %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms  failed %d" % (
+        name, len(latencies) / elapsed,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        failures))
+
+
+@gen.coroutine
+def bench_login(client):
+    result = yield run_concurrently(
+        lambda i: client.get_authenticated_user(
+            redirect_uri="http://example.com/back", code="code%d" % i),
+        options.requests, options.concurrency)
+    report("login", *result)
+
+
+@gen.coroutine
+def bench_users_show(client):
+    # 100 distinct users so that the cache, if enabled, gets some hits
+    result = yield run_concurrently(
+        lambda i: client.weibo_request("/users/show",
+            access_token="token", uid=i % 100),
+        options.requests, options.concurrency)
+    report("users/show", *result)
+
+
+@gen.coroutine
+def bench_timeline(client):
+    result = yield run_concurrently(
+        lambda i: client.weibo_request("/statuses/user_timeline",
+            access_token="token", uid=i % 100, count=50),
+        options.requests, options.concurrency)
+    report("user_timeline", *result)
+
+
+@gen.coroutine
+def bench_upload(client):
+    pic = {
+        "filename": "bench.png",
+        "content": b"\0" * options.upload_size,
+        "mime_type": "image/png",
+    }
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    result = yield client.weibo_request("/statuses/upload",
+        access_token="token", status="benchmark", pic=pic)
+    elapsed = time.time() - start
+    peak = 0
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print("%-16s %8.1f MB/s  peak memory %.1f MB over the %.1f MB picture%s" % (
+        "upload", options.upload_size / elapsed / 2 ** 20, peak / 2.0 ** 20,
+        options.upload_size / 2.0 ** 20, "" if result else "  failed"))
+
+
+def wait_for_server(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise Exception("The stand-in server did not start")
+
+
+def main():
+    options.parse_command_line()
+    server = multiprocessing.Process(target=fake_weibo.serve,
+        args=(options.port, options.latency, options.error_rate, True))
+    server.daemon = True
+    server.start()
+    try:
+        wait_for_server(options.port)
+        settings = {
+            "weibo_app_key": "bench",
+            "weibo_app_secret": "bench",
+            "weibo_api_url": "http://127.0.0.1:%d" % options.port,
+            "weibo_max_connections": options.concurrency,
+        }
+        if options.cache:
+            settings["weibo_response_cache"] = ResponseCache()
+            settings["weibo_request_coalescer"] = RequestCoalescer()
+        client = WeiboClient(settings)
+
+        @gen.coroutine
+        def run():
+            yield bench_login(client)
+            yield bench_users_show(client)
+            yield bench_timeline(client)
+            yield bench_upload(client)
+
+        IOLoop.current().run_sync(run)
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,24 @@
 import tornado.ioloop
 import tornado.web
 import tornado.escape
+import tornado.gen
 import logging
 import math
 from tornado_weibo.auth import WeiboMixin
+from tornado_weibo.session import MemorySessionStore, LoginCache
 
 
 class AuthenticationHandler(tornado.web.RequestHandler, WeiboMixin):
 
-    @tornado.web.asynchronous
+    @tornado.gen.coroutine
     def get(self):
         code = self.get_argument("code", None)
         if code:
-            self.get_authenticated_user(
+            user = yield self.get_authenticated_user(
                 redirect_uri="http://example.com/back",
-                code=code,
-                callback=self.async_callback(self._on_authorize,
-                    next=self.get_argument("next", "/"))
+                code=code
             )
+            self._on_authorize(user, next=self.get_argument("next", "/"))
             return
         self.authorize_redirect(
             redirect_uri="http://example.com/back")
@@ -27,28 +28,25 @@ class AuthenticationHandler(tornado.web.RequestHandler, WeiboMixin):
             self.send_error()
             return
 
-        # session expires in user["session_expires"] sec
-        self.set_secure_cookie("weibo_session",
-            tornado.escape.json_encode(user),
+        # the session is saved to weibo_session_store, only the uid is
+        # kept in the cookie, session expires in user["session_expires"] sec
+        self.set_secure_cookie("weibo_uid", str(user["id"]),
             math.ceil(user["session_expires"] / 86400.0))
         self.redirect(next)
 
 
-class HomeHandler(tornado.web.RequestHandler):
+class HomeHandler(tornado.web.RequestHandler, WeiboMixin):
 
-    def get_current_user(self):
-        session = self.get_secure_cookie("weibo_session")
-        if session is None:
-            return None
-        user = tornado.escape.json_decode(session)
-        return user
+    @tornado.gen.coroutine
+    def prepare(self):
+        self.current_user = yield self.get_current_weibo_user()
 
     def get_login_url(self):
         return "/login"
 
     @tornado.web.authenticated
     def get(self):
-        user = self.get_current_user()
+        user = self.current_user
         self.write("hello %s, you are from %s?, data : <br> %s" % (
             user.get("name"),
             user.get("location"),
@@ -64,6 +62,8 @@ if __name__ == "__main__":
         "weibo_app_key": "",
         "weibo_app_secret": "",
         "cookie_secret": "",
+        "weibo_session_store": MemorySessionStore(),
+        "weibo_login_cache": LoginCache(),
     }
 
     application = tornado.web.Application([
@@ -1,17 +1,191 @@
+import io
 import os
-import urllib
+import time
 import logging
-import mimetools
-import itertools
+import weakref
+import collections
+from urllib.parse import urlencode
 from tornado.auth import OAuth2Mixin
 from tornado.httputil import url_concat
+from tornado.ioloop import IOLoop
 from tornado import httpclient
 from tornado import escape
+from tornado import gen
+from tornado import locks
+from tornado_weibo.endpoints import get_endpoint, endpoint_url
+from tornado_weibo.endpoints import encode_args, with_access_token
+from tornado_weibo.endpoints import ITEM_LIST_KEYS
 
 # the default ca-certs shipped with Ubuntu failed to validate Weibo's cert
 # we are using our own ca-certs(added GeoTrust CAs) here
 _CA_CERTS = os.path.dirname(__file__) + "/ca-certificates.crt"
 
+_WEIBO_API_URL = "https://api.weibo.com"
+
+_DEFAULT_MAX_CONNECTIONS = 10
+
+_DEFAULT_MAX_UPLOADS = 2
+
+_DEFAULT_SESSION_REFRESH = 300
+
+# arguments asking for a page other than the newest one
+_PAGING_ARGS = frozenset(["since_id", "max_id", "page", "cursor"])
+
+_json_decode = None
+
+# one SSL context per process and one HTTP client per IOLoop, so the
+# bundled CA file is parsed once and connections to api.weibo.com are reused
+_ssl_context = None
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def _get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        import ssl
+        _ssl_context = ssl.create_default_context(cafile=_CA_CERTS)
+    return _ssl_context
+
+
+def preload():
+    """
+    Load what tornado_weibo otherwise loads on first use: the SSL context
+    with the bundled CA certificates and the upload support.
+
+    Call it before :func:`tornado.process.fork_processes` so the forked
+    workers share them instead of loading them once per worker::
+
+        tornado_weibo.auth.preload()
+        tornado.process.fork_processes(0)
+    """
+    _get_ssl_context()
+    import tornado_weibo.multipart
+    import tornado_weibo.paginate
+
+
+def __getattr__(name):
+    # MultiPartForm lives in tornado_weibo.multipart, loaded on first use
+    if name == "MultiPartForm":
+        from tornado_weibo.multipart import MultiPartForm
+        return MultiPartForm
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _get_http_client(settings, streaming=False):
+    """
+    Return the HTTP client shared by all Weibo API calls on the current IOLoop.
+
+    ``CurlAsyncHTTPClient`` is preferred when ``pycurl`` is available since it
+    keeps connections alive between requests, otherwise the simple client is
+    used with the shared SSL context, which opens a new connection for each
+    request. The curl client does not support ``body_producer``, requests
+    with a streamed body (``streaming``) always use a simple client of their
+    own.
+
+    ``weibo_max_connections`` in the application settings limits the number
+    of concurrent requests of the client, not per host, and
+    ``weibo_max_uploads`` those of the streaming client. They are read when
+    the clients are created for the first time.
+    """
+    io_loop = IOLoop.current()
+    clients = _http_clients.setdefault(io_loop, {})
+    client = clients.get(streaming)
+    if client is not None:
+        return client
+    if streaming:
+        max_clients = settings.get("weibo_max_uploads", _DEFAULT_MAX_UPLOADS)
+    else:
+        max_clients = settings.get("weibo_max_connections",
+                                   _DEFAULT_MAX_CONNECTIONS)
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+        except ImportError:
+            pass
+        else:
+            client = CurlAsyncHTTPClient(force_instance=True,
+                max_clients=max_clients,
+                defaults={"ca_certs": _CA_CERTS})
+    if client is None:
+        from tornado.simple_httpclient import SimpleAsyncHTTPClient
+        client = SimpleAsyncHTTPClient(force_instance=True,
+            max_clients=max_clients,
+            defaults={"ssl_options": _get_ssl_context()})
+    clients[streaming] = client
+    return client
+
+
+def _json_decoder():
+    """Return the fastest JSON decoder available."""
+    global _json_decode
+    if _json_decode is None:
+        try:
+            import orjson
+            _json_decode = orjson.loads
+        except ImportError:
+            try:
+                import ujson
+                _json_decode = ujson.loads
+            except ImportError:
+                _json_decode = escape.json_decode
+    return _json_decode
+
+
+def _field_tree(fields):
+    # ["id", "user.name", "user.id"] -> {"id": None, "user": {"name": None,
+    # "id": None}}, None means the whole value is kept
+    tree = {}
+    for field in fields:
+        node = tree
+        names = field.split(".")
+        for name in names[:-1]:
+            child = node.get(name, {})
+            if child is None:
+                break
+            node = node.setdefault(name, child)
+        else:
+            node[names[-1]] = None
+    return tree
+
+
+def _project(value, tree):
+    if isinstance(value, list):
+        return [_project(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    # timeline-like responses, keep the paging keys and project the items
+    for key in ITEM_LIST_KEYS:
+        if isinstance(value.get(key), list) and key not in tree:
+            result = dict(value)
+            result[key] = [_project(item, tree) for item in value[key]]
+            return result
+    result = {}
+    for key, subtree in tree.items():
+        if key in value:
+            result[key] = (value[key] if subtree is None
+                           else _project(value[key], subtree))
+    return result
+
+
+def _replace_body(response, body):
+    """Return a copy of ``response`` with ``body``, as a ``200`` response."""
+    return httpclient.HTTPResponse(response.request, 200,
+        headers=response.headers, buffer=io.BytesIO(body),
+        effective_url=response.effective_url,
+        request_time=response.request_time, time_info=response.time_info)
+
+
+def _future_callback(future, callback):
+    """
+    Return ``future``, ``callback`` is called with its result when done.
+
+    This keeps the callback style API working on top of the coroutines.
+    """
+    if callback is not None:
+        IOLoop.current().add_future(future,
+            lambda future: callback(future.result()))
+    return future
+
+
 class WeiboMixin(OAuth2Mixin):
     """
     The :class:`tornado.web.RequestHandler` mixin.
@@ -20,6 +194,47 @@ class WeiboMixin(OAuth2Mixin):
     _OAUTH_AUTHORIZE_URL = "https://api.weibo.com/oauth2/authorize?"
     _OAUTH_NO_CALLBACKS = False
 
+    # path: (ids parameter, max ids per request, key of the item list in
+    # the response or None if the response is the list, id key of items)
+    _WEIBO_BATCH_APIS = {
+        "/users/show_batch": ("uids", 50, "users", "id"),
+        "/users/counts": ("uids", 100, None, "id"),
+        "/statuses/show_batch": ("ids", 50, "statuses", "id"),
+        "/statuses/count": ("ids", 100, None, "id"),
+    }
+
+    # path: (paging, key of the item list in the response), see
+    # tornado_weibo.paginate.WeiboPaginator
+    _WEIBO_PAGINATED_APIS = {
+        "/statuses/public_timeline": ("page", "statuses"),
+        "/statuses/home_timeline": ("max_id", "statuses"),
+        "/statuses/friends_timeline": ("max_id", "statuses"),
+        "/statuses/user_timeline": ("max_id", "statuses"),
+        "/statuses/mentions": ("max_id", "statuses"),
+        "/statuses/repost_timeline": ("max_id", "reposts"),
+        "/comments/show": ("max_id", "comments"),
+        "/comments/by_me": ("max_id", "comments"),
+        "/comments/to_me": ("max_id", "comments"),
+        "/comments/timeline": ("max_id", "comments"),
+        "/favorites": ("page", "favorites"),
+        "/friendships/friends": ("cursor", "users"),
+        "/friendships/followers": ("cursor", "users"),
+    }
+
+    # path: key of the item list in the response, for timelines which can
+    # be revalidated by asking for the items newer than the newest one kept
+    _WEIBO_SINCE_ID_APIS = {
+        "/statuses/home_timeline": "statuses",
+        "/statuses/friends_timeline": "statuses",
+        "/statuses/user_timeline": "statuses",
+        "/statuses/mentions": "statuses",
+        "/statuses/repost_timeline": "reposts",
+        "/comments/show": "comments",
+        "/comments/by_me": "comments",
+        "/comments/to_me": "comments",
+        "/comments/timeline": "comments",
+    }
+
     def authorize_redirect(self, redirect_uri, extra_params=None):
         """
         Redirect user to the weibo authorization page.
@@ -41,24 +256,45 @@ class WeiboMixin(OAuth2Mixin):
             url_concat(self._OAUTH_AUTHORIZE_URL, args)
         )
 
-    def get_authenticated_user(self, redirect_uri,
-                               code, callback, extra_fields=None):
+    def get_authenticated_user(self, redirect_uri, code, callback=None,
+                               extra_fields=None, extra_lookups=None):
         """
         Get the authenticated user by given ``authorization_code``
 
-        The ``callback`` function will be called with response of
+        Returns a :class:`~tornado.concurrent.Future` of the response of
         ``/users/show`` which is a dict with some information
-        of specific user. ``access_token`` and ``session_expires``
-        are also set in this dict, you should store ``access_token``
-        to database/session for later use.
-
-        This function calls ``OAuth2/access_token``, ``/account/get_uid``
-        and ``/users/show`` internally, see
+        of specific user, ``None`` if the authentication failed.
+        ``access_token`` and ``session_expires`` are also set in this dict,
+        you should store ``access_token`` to database/session for later use,
+        it is saved to ``weibo_session_store`` if that is set, see
+        :func:`get_current_weibo_user`. If ``callback`` is given, it is
+        called with the result as well.
+
+        ``extra_lookups`` is an optional dict of additional per-user API
+        calls, which are sent together with ``/users/show``. The key is
+        the key of the result in the user dict and the value is the API
+        path, or a ``(path, uid_param)`` tuple if the API does not take
+        the user id as ``uid``, e.g.
+        ``{"counts": ("/users/counts", "uids")}``. The result of a failed
+        lookup is ``None``.
+
+        This function calls ``OAuth2/access_token`` and ``/users/show``
+        internally, ``/account/get_uid`` is only called if the access token
+        response does not contain ``uid``, see
         http://open.weibo.com/wiki/OAuth2/access_token
+
+        If ``weibo_login_cache`` is set, the profile and lookups of a user
+        who logged in lately are answered from the cache, only the code is
+        exchanged for a token, see :class:`tornado_weibo.session.LoginCache`.
         """
         self.require_setting("weibo_app_key", "Weibo OAuth2")
         self.require_setting("weibo_app_secret", "Weibo OAuth2")
-        http = httpclient.AsyncHTTPClient()
+        return _future_callback(self._get_authenticated_user(redirect_uri,
+            code, extra_fields, extra_lookups), callback)
+
+    @gen.coroutine
+    def _get_authenticated_user(self, redirect_uri, code, extra_fields,
+                                extra_lookups):
         args = {
             "redirect_uri": redirect_uri,
             "extra_params": {"grant_type": 'authorization_code'},
@@ -72,191 +308,612 @@ class WeiboMixin(OAuth2Mixin):
             fields.update(extra_fields)
 
         # Weibo's oauth2 access_token only accepts POST method
-        http.fetch(self._OAUTH_ACCESS_TOKEN_URL, method="POST",
-            body=urllib.urlencode(args),
-            callback=self.async_callback(self._on_access_token,
-                callback, fields),
-            ca_certs=_CA_CERTS
-        )
-
-    def _on_access_token(self, callback, fields, response):
+        # the code can only be exchanged once, but a failed exchange is
+        # safe to retry
+        response = yield self._weibo_fetch(httpclient.HTTPRequest(
+            self._weibo_url(self._OAUTH_ACCESS_TOKEN_URL), method="POST",
+            body=urlencode(args)), "/oauth2/access_token", retry=True)
         if response.error:
             logging.warning('Weibo auth error: %s' % str(response))
-            callback(None)
-            return
+            raise gen.Return(None)
 
-        session = escape.json_decode(response.body)
+        session = self._weibo_decode(response.body)
 
-        self.weibo_request(
-            path="/account/get_uid",
-            callback=self.async_callback(
-                self._on_get_uid, callback, session, fields),
-            access_token=session["access_token"]
-        )
-
-    def _on_get_uid(self, callback, session, fields, response):
-        if response is None or not "uid" in response:
-            callback(None)
-            return
-
-        self.weibo_request(
-            path="/users/show",
-            callback=self.async_callback(
-                self._on_get_user_info, callback, session, fields),
-            access_token=session["access_token"],
-            uid=response["uid"]
+        # the access token response usually carries the uid already
+        uid = session.get("uid")
+        if not uid:
+            response = yield self.weibo_request(
+                path="/account/get_uid",
+                access_token=session["access_token"]
+            )
+            if response is None or not "uid" in response:
+                raise gen.Return(None)
+            uid = response["uid"]
+
+        lookups = {None: ("/users/show", "uid")}
+        for key, lookup in (extra_lookups or {}).items():
+            if not isinstance(lookup, tuple):
+                lookup = (lookup, "uid")
+            lookups[key] = lookup
+
+        cache = self.settings.get("weibo_login_cache")
+        cached = None
+        if cache is not None:
+            cached = cache.get(uid, fields.union(
+                key for key in lookups if key is not None))
+        if cached is not None:
+            # a repeated login, the profile is known already
+            profile, refresh = cached
+            self._weibo_event("/oauth2/access_token", "login_cache_hit")
+            if refresh:
+                self._refresh_weibo_profile(session, uid, fields, lookups)
+            user = dict(profile, access_token=session["access_token"],
+                        session_expires=session.get("expires_in"))
+            cache.set_token(uid, session["access_token"],
+                            self._weibo_expires_at(session))
+        else:
+            user, extras = yield self._weibo_lookup_user(session, uid, fields,
+                                                         lookups)
+            user = self._on_get_user_info(session, fields, user, extras, uid)
+        store = self.settings.get("weibo_session_store")
+        if user is not None and store is not None:
+            yield store.set(uid, self._weibo_session(session, uid, user))
+        raise gen.Return(user)
+
+    @gen.coroutine
+    def _weibo_lookup_user(self, session, uid, fields, lookups):
+        # all lookups are independent, send them at once and wait for all
+        # only the fields of /users/show which are returned are kept
+        results = yield dict(
+            (key, self.weibo_request(path=path,
+                access_token=session["access_token"],
+                fields=fields if key is None else None, **{uid_param: uid}))
+            for key, (path, uid_param) in lookups.items()
         )
-
-    def _on_get_user_info(self, callback, session, fields, user):
+        user = results.pop(None)
+        raise gen.Return((user, results))
+
+    @gen.coroutine
+    def _refresh_weibo_profile(self, session, uid, fields, lookups):
+        # runs in the background, the login does not wait for it
+        try:
+            user, extras = yield self._weibo_lookup_user(session, uid, fields,
+                                                         lookups)
+            self._on_get_user_info(session, fields, user, extras, uid)
+        except Exception:
+            logging.exception("Weibo profile refresh of %s failed", uid)
+
+    def _on_get_user_info(self, session, fields, user, extras, uid=None):
         if user is None:
-            callback(None)
-            return
+            return None
 
         fieldmap = {}
         for field in fields:
             fieldmap[field] = user.get(field)
 
+        fieldmap.update(extras)
+        cache = self.settings.get("weibo_login_cache")
+        if cache is not None and uid is not None:
+            cache.set(uid, session["access_token"],
+                      self._weibo_expires_at(session), dict(fieldmap))
         fieldmap.update({"access_token": session["access_token"],
                          "session_expires": session.get("expires_in")})
-        callback(fieldmap)
+        return fieldmap
+
+    def _weibo_expires_at(self, token):
+        expires_in = token.get("expires_in")
+        return time.time() + int(expires_in) if expires_in else None
+
+    def _weibo_session(self, token, uid, user):
+        # build the session saved to weibo_session_store from the response
+        # of OAuth2/access_token
+        expires_in = token.get("expires_in")
+        user = dict(user, access_token=token["access_token"],
+                    session_expires=expires_in)
+        return {
+            "uid": str(uid),
+            "access_token": token["access_token"],
+            "refresh_token": token.get("refresh_token"),
+            "expires_at": self._weibo_expires_at(token),
+            "user": user,
+        }
 
-    def weibo_request(self, path, callback, access_token=None,
-                      post_args=None, **args):
+    def get_current_weibo_user(self, callback=None):
+        """
+        Get the logged in user from ``weibo_session_store``.
+
+        Returns a :class:`~tornado.concurrent.Future` of the dict returned by
+        :func:`get_authenticated_user` when the user logged in, ``None`` if
+        the user is not logged in or the session has expired. If
+        ``callback`` is given, it is called with the result as well.
+
+        The user id is read from the secure cookie named by the
+        ``weibo_session_cookie`` setting (``"weibo_uid"`` by default), set it
+        after the user logs in, e.g.
+        ``self.set_secure_cookie("weibo_uid", str(user["id"]))``. No API is
+        called unless the access token expires within
+        ``weibo_session_refresh`` seconds (default ``300``) and Weibo gave a
+        ``refresh_token``, then the access token is refreshed.
+        """
+        self.require_setting("weibo_session_store", "Weibo sessions")
+        return _future_callback(self._get_current_weibo_user(), callback)
+
+    @gen.coroutine
+    def _get_current_weibo_user(self):
+        uid = self.get_secure_cookie(
+            self.settings.get("weibo_session_cookie", "weibo_uid"))
+        if not uid:
+            raise gen.Return(None)
+        session = yield self.settings["weibo_session_store"].get(
+            escape.native_str(uid))
+        if session is None:
+            raise gen.Return(None)
+        expires_at = session.get("expires_at")
+        margin = self.settings.get("weibo_session_refresh",
+                                   _DEFAULT_SESSION_REFRESH)
+        if (session.get("refresh_token") and expires_at is not None and
+                expires_at - time.time() < margin):
+            session = yield self._refresh_weibo_session(session)
+        raise gen.Return(session["user"] if session else None)
+
+    @gen.coroutine
+    def _refresh_weibo_session(self, session):
+        args = {
+            "grant_type": "refresh_token",
+            "refresh_token": session["refresh_token"],
+            "client_id": self.settings["weibo_app_key"],
+            "client_secret": self.settings["weibo_app_secret"],
+            }
+        response = yield self._weibo_fetch(httpclient.HTTPRequest(
+            self._weibo_url(self._OAUTH_ACCESS_TOKEN_URL), method="POST",
+            body=urlencode(args)), "/oauth2/access_token", retry=True)
+        if response.error:
+            logging.warning('Weibo token refresh error: %s' % str(response))
+            # the old token may still be valid for a while
+            raise gen.Return(None if session["expires_at"] <= time.time()
+                             else session)
+        token = self._weibo_decode(response.body)
+        token.setdefault("refresh_token", session["refresh_token"])
+        session = self._weibo_session(token, session["uid"], session["user"])
+        yield self.settings["weibo_session_store"].set(session["uid"], session)
+        raise gen.Return(session)
+
+    def weibo_request(self, path, callback=None, access_token=None,
+                      post_args=None, background=False, fields=None, model=None,
+                      raw=False, **args):
         """
         This is a helper function to send Weibo API requests.
 
         ``path`` should be set to the API path which the request is sent to,
         e.g. ``'statuses/public_timeline'``.
 
-        A dict containing user information will be passed to ``callback``
-        function.
+        Returns a :class:`~tornado.concurrent.Future` of the parsed
+        response, ``None`` if the request failed. If ``callback`` is given,
+        it is called with the result as well.
 
         If ``post_args`` is given, the request will be sent using POST method
         with ``post_args``. Anything in the keyword arguments will sent
-        as HTTP query string.
+        as HTTP query string, or as POST body for APIs known to require POST,
+        e.g. ``/statuses/update``. Requests to known APIs missing a required
+        parameter are not sent and the result is ``None``, see
+        :mod:`tornado_weibo.endpoints`.
+
+        If ``weibo_response_cache`` is set in the application settings,
+        responses of GET requests are served from the cache while fresh,
+        see :class:`tornado_weibo.cache.ResponseCache`. Expired responses
+        are revalidated with ``If-None-Match`` and ``If-Modified-Since`` if
+        Weibo sent an ``ETag`` or a ``Last-Modified`` date, and timelines
+        ask only for the items newer than the newest one kept. Identical GET
+        requests in flight at the same time are sent only once if
+        ``weibo_request_coalescer`` is set, see
+        :class:`tornado_weibo.cache.RequestCoalescer`.
+
+        If ``weibo_rate_limiter`` is set, requests are delayed to stay within
+        Weibo's rate limits and the result is ``None`` if a request can not
+        be sent in time, see :class:`tornado_weibo.ratelimit.RateLimiter`.
+        Requests of background jobs should set ``background`` so that they
+        never use up the budget of interactive requests.
+
+        Failed GET requests are retried if ``weibo_retry_policy`` is set,
+        each retry counts against the rate limits like a new request, and
+        APIs which keep failing are not called for a while if
+        ``weibo_circuit_breaker`` is set, see :mod:`tornado_weibo.retry`.
+
+        Latency, status codes, sizes and the outcomes above are recorded
+        per API if ``weibo_stats`` is set, see
+        :class:`tornado_weibo.metrics.WeiboStats`.
+
+        If ``fields`` is given, only these keys of the response are kept,
+        nested keys are separated by dots, e.g.
+        ``fields=["id", "text", "user.name"]``. For responses with a list of
+        items, e.g. ``statuses`` of a timeline, the keys of the items are
+        kept along with the other keys of the response. Responses are
+        decoded with ``orjson`` or ``ujson`` if installed, or with the
+        ``weibo_json_decoder`` setting if set.
+
+        If ``model`` is given, e.g. :class:`tornado_weibo.models.WeiboStatus`,
+        the response, or its list of items, is returned as compact models
+        instead of dicts, see :mod:`tornado_weibo.models`.
+
+        If ``raw`` is set, the :class:`~tornado.httpclient.HTTPResponse` is
+        returned as it is, errors included, and never served from the cache,
+        e.g. to look at the error code of a failed post. The result is still
+        ``None`` if the request was not sent.
 
         .. note:: For ``/statuses/upload`` method, the ``pic`` parameter is
            required and it should be a dict with key ``filename``, ``content`` and
            ``mime_type``. ``/statuses/upload`` requires a ``multipart/form-data``
            post request, therefore it must be handled differently. tornado_weibo
            already knows how to construct a ``multipart/form-data`` request, so you
-           don't have to do extra work besides providing the ``pic`` dict. See
+           don't have to do extra work besides providing the ``pic`` dict.
+           ``content`` may also be a ``memoryview``, an ``mmap`` or a file
+           object, or ``path`` may be given instead of ``content``, the
+           request body is streamed so the picture is not copied.
+           ``filename`` defaults to the name of ``path`` and ``mime_type`` is
+           sniffed from the picture if not given. If ``weibo_upload_max_size``
+           is set, pictures larger than it or not a JPEG, PNG or GIF are
+           rejected before anything is sent and the result is ``None``. See
            http://open.weibo.com/wiki/Statuses/upload
         """
-        url = "https://api.weibo.com/2" + path + ".json"
+        return _future_callback(self._weibo_request(path, access_token,
+            post_args, background, fields, args, raw=raw, model=model),
+            callback)
+
+    @gen.coroutine
+    def _weibo_request(self, path, access_token, post_args, background,
+                       fields, args, raw=False, model=None):
+        # with raw, the HTTPResponse is returned instead of the result,
+        # or None if the request was not sent
+        endpoint = get_endpoint(path)
+        url = endpoint_url(self.settings.get("weibo_api_url") or
+                           _WEIBO_API_URL, path)
         if path == "/statuses/upload": # this request should be handled differently
-            return self._weibo_upload_request(url, callback,
+            allowed = yield self._weibo_rate_limit(path, access_token,
+                background)
+            if not allowed:
+                raise gen.Return(None)
+            response = yield self._weibo_upload_request(url,
                 access_token, args.get("pic"), status=args.get("status"))
-        all_args = {}
-        if access_token:
-            all_args["access_token"] = access_token
-            all_args.update(args)
-            all_args.update(post_args or {})
-        if all_args:
-            url += "?" + urllib.urlencode(all_args)
-        callback = self.async_callback(self._on_weibo_request, callback)
-        http = httpclient.AsyncHTTPClient()
+            if raw or response is None:
+                raise gen.Return(response)
+            raise gen.Return(self._on_weibo_request(response, model=model))
+        if endpoint.method == "POST" and post_args is None:
+            post_args, args = args, {}
+        missing = endpoint.missing_args(
+            dict(args, **post_args) if post_args else args)
+        if missing:
+            logging.warning("Missing %s of Weibo API %s", ", ".join(missing),
+                            path)
+            raise gen.Return(None)
+        # encoded once, the query string is also the cache key
+        query = encode_args(args)
+        cacheable = endpoint.cacheable and post_args is None and not raw
+        cache = self.settings.get("weibo_response_cache")
+        cache_key = None
+        if cache is not None and cacheable:
+            cache_key = cache.key(path, access_token, query)
+            body = cache.get(cache_key) if cache_key is not None else None
+            if cache_key is not None:
+                self._weibo_event(path,
+                    "cache_hit" if body is not None else "cache_miss")
+            if body is not None:
+                raise gen.Return(self._weibo_decode(body, fields, model))
+        coalescer = self.settings.get("weibo_request_coalescer")
+        inflight_key = None
+        if coalescer is not None and cacheable:
+            inflight_key = coalescer.key(path, access_token, query)
+            inflight = coalescer.join(inflight_key)
+            if inflight is not None:
+                self._weibo_event(path, "coalesced")
+                response = yield inflight
+                raise gen.Return(self._on_weibo_request(response, fields,
+                                                        model))
+        headers = {}
+        stale = cache.stale(cache_key) if cache_key is not None else None
+        if stale is not None:
+            validators = stale[1]
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last_modified" in validators:
+                headers["If-Modified-Since"] = validators["last_modified"]
+            if "since_id" in validators:
+                query = encode_args(dict(args, since_id=validators["since_id"]))
+        query = with_access_token(query, access_token)
+        if query:
+            url += "?" + query
+        # gzip is asked for explicitly, timelines compress very well
         if post_args is not None:
-            http.fetch(url, method="POST", body=urllib.urlencode(post_args),
-                callback=callback, ca_certs=_CA_CERTS)
+            request = httpclient.HTTPRequest(url, method="POST",
+                body=encode_args(post_args), decompress_response=True)
         else:
-            http.fetch(url, callback=callback, ca_certs=_CA_CERTS)
-
-    def _weibo_upload_request(self, url, callback,
-                              access_token, pic, status=None):
+            request = httpclient.HTTPRequest(url, headers=headers,
+                decompress_response=True)
+        fetch = self._weibo_limited_fetch(path, access_token, background,
+            request)
+        if cache_key is not None:
+            fetch = self._weibo_cached_fetch(path, fetch, cache, cache_key,
+                stale, args)
+        if inflight_key is not None:
+            coalescer.start(inflight_key, fetch)
+        try:
+            response = yield fetch
+        finally:
+            if inflight_key is not None:
+                coalescer.finish(inflight_key)
+        if raw:
+            raise gen.Return(response)
+        raise gen.Return(self._on_weibo_request(response, fields, model))
+
+    @gen.coroutine
+    def _weibo_cached_fetch(self, path, fetch, cache, key, stale, args):
+        # stores the response of fetch in the cache, or revalidates the
+        # stale (body, validators), returns a response with the whole body
+        response = yield fetch
+        if stale is not None and response.code == 304:
+            cache.revalidated(key)
+            self._weibo_event(path, "revalidated")
+            raise gen.Return(_replace_body(response, stale[0]))
+        if response.error:
+            raise gen.Return(response)
+        body = response.body
+        validators = {}
+        items_key = self._WEIBO_SINCE_ID_APIS.get(path)
+        if items_key is not None and not _PAGING_ARGS.intersection(args):
+            page = self._weibo_decode(body)
+            items = page.get(items_key) if isinstance(page, dict) else None
+            if stale is not None and "since_id" in stale[1]:
+                if not items:
+                    # nothing newer than the stale response
+                    cache.revalidated(key)
+                    self._weibo_event(path, "revalidated")
+                    raise gen.Return(_replace_body(response, stale[0]))
+                count = int(args.get("count", 20))
+                if len(items) < count:
+                    # the new items followed by the newest ones kept is
+                    # what a full request would have returned
+                    kept = self._weibo_decode(stale[0]).get(items_key) or []
+                    page[items_key] = items = (items +
+                                               kept[:count - len(items)])
+                    body = escape.utf8(escape.json_encode(page))
+                    response = _replace_body(response, body)
+                    self._weibo_event(path, "merged")
+            if items:
+                validators["since_id"] = max(int(item["id"])
+                                             for item in items)
+        if response.headers.get("Etag"):
+            validators["etag"] = response.headers["Etag"]
+        if response.headers.get("Last-Modified"):
+            validators["last_modified"] = response.headers["Last-Modified"]
+        cache.set(key, body, validators or None)
+        raise gen.Return(response)
+
+    def weibo_batch_request(self, path, ids, callback=None, access_token=None,
+                            concurrency=4, **args):
+        """
+        Look up many users or statuses with a Weibo batch API.
+
+        ``path`` is one of the batch APIs, e.g. ``/users/show_batch``,
+        ``/users/counts``, ``/statuses/show_batch`` or ``/statuses/count``.
+        ``ids`` are split into as few requests as the API allows, at most
+        ``concurrency`` of them are sent at the same time. Anything in the
+        keyword arguments is sent with every request.
+
+        Returns a :class:`~tornado.concurrent.Future` of a dict mapping
+        each id to its item, ids missing from the responses, e.g. because
+        a request failed, are mapped to ``None``. If ``callback`` is given,
+        it is called with the result as well.
+        """
+        if path not in self._WEIBO_BATCH_APIS:
+            raise ValueError("%s is not a known batch API" % path)
+        return _future_callback(self._weibo_batch_request(path, ids,
+            access_token, concurrency, args), callback)
+
+    def weibo_paginate(self, path, access_token=None, pages=False,
+                       prefetch=True, until=None, max_pages=None,
+                       background=False, **args):
+        """
+        Iterate over the items of a paginated API, e.g.
+        ``/statuses/user_timeline``, ``/comments/show`` or
+        ``/friendships/followers``.
+
+        Returns a :class:`tornado_weibo.paginate.WeiboPaginator`, which
+        supports ``async for`` and yields the items of all pages, or the
+        pages themselves if ``pages`` is set. ``max_id``, ``cursor`` or
+        ``page`` are set for each page as the API requires, anything in the
+        keyword arguments is sent with every request. The next page is
+        requested while the current one is consumed unless ``prefetch`` is
+        ``False``. The iteration stops after ``max_pages`` pages, or before
+        the first item for which ``until`` returns ``True``, e.g.
+        ``until=lambda status: status["id"] <= last_seen_id``.
+        """
+        if path not in self._WEIBO_PAGINATED_APIS:
+            raise ValueError("%s is not a known paginated API" % path)
+        paging, items_key = self._WEIBO_PAGINATED_APIS[path]
+        from tornado_weibo.paginate import WeiboPaginator
+        return WeiboPaginator(self, path, paging, items_key,
+            access_token=access_token, args=args, pages=pages,
+            prefetch=prefetch, until=until, max_pages=max_pages,
+            background=background)
+
+    @gen.coroutine
+    def _weibo_batch_request(self, path, ids, access_token, concurrency, args):
+        param, limit, list_key, id_key = self._WEIBO_BATCH_APIS[path]
+        ids = list(collections.OrderedDict.fromkeys(ids))
+        semaphore = locks.Semaphore(concurrency)
+        items = {}
+
+        @gen.coroutine
+        def fetch(chunk):
+            chunk_args = dict(args)
+            chunk_args[param] = ",".join(str(id) for id in chunk)
+            with (yield semaphore.acquire()):
+                response = yield self.weibo_request(path,
+                    access_token=access_token, **chunk_args)
+            if list_key is not None and response is not None:
+                response = response.get(list_key)
+            for item in response or []:
+                items[str(item[id_key])] = item
+
+        yield [fetch(ids[i:i + limit]) for i in range(0, len(ids), limit)]
+        raise gen.Return(dict((id, items.get(str(id))) for id in ids))
+
+    @gen.coroutine
+    def _weibo_rate_limit(self, path, access_token, background):
+        limiter = self.settings.get("weibo_rate_limiter")
+        if limiter is None:
+            raise gen.Return(True)
+        allowed = yield limiter.acquire(access_token, path, background)
+        if not allowed:
+            logging.warning("Rate limit of %s reached, request dropped", path)
+            self._weibo_event(path, "rate_limited")
+        raise gen.Return(allowed)
+
+    @gen.coroutine
+    def _weibo_limited_fetch(self, path, access_token, background, request):
+        allowed = yield self._weibo_rate_limit(path, access_token, background)
+        if not allowed:
+            raise gen.Return(httpclient.HTTPResponse(request, 429,
+                error=httpclient.HTTPError(429, "Rate limit reached")))
+        response = yield self._weibo_fetch(request, path,
+            retry=request.method == "GET", limit=(access_token, background))
+        limiter = self.settings.get("weibo_rate_limiter")
+        if limiter is not None:
+            limiter.on_response(access_token, path, response)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def _weibo_upload_request(self, url, access_token, pic, status=None):
         # /statuses/upload is special
         if pic is None:
             raise Exception("pic not filled!")
-        form = MultiPartForm()
-        form.add_file("pic", pic["filename"], pic["content"], pic["mime_type"])
-
-        form.add_field("status", status)
-        headers = {
-            "Content-Type": form.get_content_type(),
-            }
-        args = {
-            "access_token": access_token
-        }
-        url += "?" + urllib.urlencode(args)
-        http = httpclient.AsyncHTTPClient()
-        http.fetch(url, method="POST", body=str(form),
-            callback=self.async_callback(self._on_weibo_request, callback),
-            headers=headers,
-            ca_certs=_CA_CERTS)
-
-    def _on_weibo_request(self, callback, response):
+        from tornado_weibo.multipart import MultiPartForm, body_size
+        from tornado_weibo.multipart import sniff_image
+        content = pic.get("content")
+        opened = content is None
+        if opened:
+            # read chunk by chunk while sent, never loaded as a whole
+            content = open(pic["path"], "rb")
+        try:
+            filename = pic.get("filename") or os.path.basename(pic["path"])
+            mime_type = pic.get("mime_type")
+            max_size = self.settings.get("weibo_upload_max_size")
+            if mime_type is None or max_size is not None:
+                sniffed = sniff_image(content)
+                mime_type = mime_type or sniffed or "application/octet-stream"
+            if max_size is not None:
+                # rejected before anything is sent
+                size = body_size(content)
+                if size > max_size:
+                    logging.warning("Picture %s is too large, %d > %d bytes",
+                                    filename, size, max_size)
+                    raise gen.Return(None)
+                if sniffed is None:
+                    logging.warning("Picture %s is not a JPEG, PNG or GIF",
+                                    filename)
+                    raise gen.Return(None)
+            form = MultiPartForm()
+            form.add_file("pic", filename, content, mime_type)
+
+            form.add_field("status", status)
+            # the form is streamed, Content-Length is known up front so that
+            # the body is not sent with chunked encoding
+            headers = {
+                "Content-Type": form.get_content_type(),
+                "Content-Length": str(form.get_content_length()),
+                }
+            url += "?" + with_access_token("", access_token)
+            response = yield self._weibo_fetch(httpclient.HTTPRequest(url,
+                method="POST", body_producer=form.body_producer,
+                headers=headers), "/statuses/upload")
+        finally:
+            if opened:
+                content.close()
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def _weibo_fetch(self, request, endpoint, retry=False, limit=None):
+        # errors are returned in the response instead of being raised; with
+        # limit, the (access token, background) of a rate limited request,
+        # retries wait for the rate limiter as well
+        breaker = self.settings.get("weibo_circuit_breaker")
+        if breaker is not None and not breaker.allow(endpoint):
+            self._weibo_event(endpoint, "circuit_open")
+            raise gen.Return(httpclient.HTTPResponse(request, 503,
+                error=httpclient.HTTPError(503, "Circuit open")))
+        policy = self.settings.get("weibo_retry_policy") if retry else None
+        if policy is not None:
+            request.request_timeout = policy.attempt_timeout
+        http = _get_http_client(self.settings,
+            streaming=request.body_producer is not None)
+        stats = self.settings.get("weibo_stats")
+        attempt = 1
+        while True:
+            try:
+                response = yield http.fetch(request, raise_error=False)
+            except Exception as e:
+                response = httpclient.HTTPResponse(request, 599, error=e)
+            if stats is not None:
+                stats.record_fetch(endpoint, request, response)
+            if breaker is not None:
+                breaker.record(endpoint, response)
+            if policy is None or not policy.should_retry(attempt, response):
+                raise gen.Return(response)
+            if breaker is not None and not breaker.allow(endpoint):
+                raise gen.Return(response)
+            yield gen.sleep(policy.backoff(attempt))
+            if limit is not None:
+                # every attempt counts against the rate limits of Weibo
+                allowed = yield self._weibo_rate_limit(endpoint, *limit)
+                if not allowed:
+                    raise gen.Return(response)
+            policy.retries += 1
+            self._weibo_event(endpoint, "retry")
+            attempt += 1
+
+    def _weibo_url(self, url):
+        # weibo_api_url replaces https://api.weibo.com, e.g. to send the
+        # requests to a local stand-in server
+        base = self.settings.get("weibo_api_url")
+        if base and url.startswith(_WEIBO_API_URL):
+            url = base + url[len(_WEIBO_API_URL):]
+        return url
+
+    def _weibo_event(self, endpoint, event):
+        stats = self.settings.get("weibo_stats")
+        if stats is not None:
+            stats.record_event(endpoint, event)
+
+    def _on_weibo_request(self, response, fields=None, model=None):
         if response.error:
             logging.warning("Error response %s fetching %s, body %s",
                 response.error,
                 response.request.url,
                 response.body
             )
-            callback(None)
-            return
-        callback(escape.json_decode(response.body))
+            return None
+        return self._weibo_decode(response.body, fields, model)
 
+    def _weibo_decode(self, body, fields=None, model=None):
+        decoder = self.settings.get("weibo_json_decoder") or _json_decoder()
+        result = decoder(body)
+        if fields is not None:
+            result = _project(result, _field_tree(fields))
+        if model is not None:
+            from tornado_weibo.models import build
+            result = build(model, result)
+        return result
 
-class MultiPartForm(object):
-    """Helper class to build a multipart form
 
-    This part was copied from http://www.doughellmann.com/PyMOTW/urllib2/
+class WeiboClient(WeiboMixin):
+    """
+    :class:`WeiboMixin` for use outside of request handlers, e.g. in
+    background jobs. ``settings`` are the same as the application settings.
     """
 
-    def __init__(self):
-        self.form_fields = []
-        self.files = []
-        self.boundary = mimetools.choose_boundary()
-        return
-
-    def get_content_type(self):
-        return 'multipart/form-data; boundary=%s' % self.boundary
-
-    def add_field(self, name, value):
-        """Add a simple field to the form data."""
-        self.form_fields.append((name, value))
-        return
-
-    def add_file(self, fieldname, filename, body, mimetype):
-        """Add a file to be uploaded."""
-        self.files.append((fieldname, filename, mimetype, body))
-        return
-
-    def __str__(self):
-        """Return a string representing the form data,
-        including attached files.
-        """
-        # Build a list of lists, each containing "lines" of the
-        # request.  Each part is separated by a boundary string.
-        # Once the list is built, return a string where each
-        # line is separated by '\r\n'.
-        parts = []
-        part_boundary = '--' + self.boundary
-
-        # Add the form fields
-        parts.extend(
-            [part_boundary,
-             'Content-Disposition: form-data; name="%s"' % name,
-             '',
-             value,
-             ]
-            for name, value in self.form_fields
-        )
-
-        # Add the files to upload
-        parts.extend(
-            [part_boundary,
-             'Content-Disposition: form-data; name="%s"; filename="%s"' %\
-             (field_name, filename),
-             'Content-Type: %s' % content_type,
-             '',
-             body,
-             ]
-            for field_name, filename, content_type, body in self.files
-        )
+    def __init__(self, settings):
+        self.settings = settings
 
-        # Flatten the list and add closing boundary marker,
-        # then return CR+LF separated data
-        flattened = list(itertools.chain(*parts))
-        flattened.append('--' + self.boundary + '--')
-        flattened.append('')
-        return '\r\n'.join(flattened)
\ No newline at end of file
+    def require_setting(self, name, feature="this feature"):
+        if not self.settings.get(name):
+            raise Exception("You must define the '%s' setting in your "
+                            "settings to use %s" % (name, feature))
@@ -0,0 +1,263 @@
+"""
+Response cache for :func:`tornado_weibo.auth.WeiboMixin.weibo_request`.
+
+The cache is opt-in, create a :class:`ResponseCache` and put it in the
+application settings as ``weibo_response_cache``::
+
+    settings = {
+        "weibo_app_key": "",
+        "weibo_app_secret": "",
+        "weibo_response_cache": ResponseCache(max_entries=10000),
+    }
+
+Only ``GET`` requests to paths with a TTL are cached. Expired responses
+with validators, an ``ETag``, a ``Last-Modified`` date or the newest
+``since_id`` of a timeline, are kept and revalidated with a conditional
+request instead of being downloaded again.
+
+Identical requests in flight at the same time can be merged into one with
+:class:`RequestCoalescer`, with or without a response cache.
+"""
+import time
+import struct
+import collections
+from tornado import escape
+from tornado_weibo.endpoints import encode_args
+
+# seconds a response of the API is considered fresh
+DEFAULT_TTLS = {
+    "/users/show": 60,
+    "/users/counts": 60,
+    "/statuses/user_timeline": 15,
+    "/emotions": 3600,
+}
+
+# responses of these APIs do not depend on the access token,
+# they are shared by all users
+PUBLIC_PATHS = frozenset([
+    "/emotions",
+])
+
+
+def request_key(path, access_token, query):
+    """
+    Return a hashable key of a request. ``query`` is the query string
+    encoded by :func:`~tornado_weibo.endpoints.encode_args`, or a dict of
+    the arguments, the order and type of the argument values does not
+    matter, i.e. ``uid=1`` and ``uid="1"`` give the same key.
+    """
+    if isinstance(query, dict):
+        query = encode_args(query)
+    return (path, access_token, query)
+
+
+class ResponseCache(object):
+    """
+    A LRU cache of raw API response bodies with per-path TTLs.
+
+    ``ttls`` maps API paths to the seconds their responses are kept,
+    responses of other paths are not cached. The cache holds at most
+    ``max_entries`` responses and ``max_bytes`` bytes of response bodies,
+    the least recently used ones are evicted first. Responses of
+    ``public_paths`` are shared by all access tokens, the other responses
+    are cached per access token. Responses of ``/users/show`` depend on who
+    asks, e.g. ``following`` and ``follow_me``, only add it if these keys
+    are never used, e.g. ``public_paths=PUBLIC_PATHS | {"/users/show"}``.
+    Expired responses with validators are kept until evicted, see
+    :func:`stale`.
+
+    If ``backend`` is given, e.g. a
+    :class:`~tornado_weibo.shared.SharedMemoryCache`, the responses are kept
+    there instead, ``max_entries`` and ``max_bytes`` are then up to the
+    backend.
+    """
+
+    def __init__(self, ttls=None, max_entries=1000, max_bytes=16 * 1024 * 1024,
+                 public_paths=PUBLIC_PATHS, backend=None):
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.public_paths = public_paths
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def key(self, path, access_token, query):
+        """Return the cache key of a request, or ``None`` if not cacheable."""
+        if not self.ttls.get(path):
+            return None
+        if path in self.public_paths:
+            access_token = None
+        return request_key(path, access_token, query)
+
+    def _load(self, key):
+        # return the (expires at, body, validators) of key, or None
+        if self.backend is not None:
+            return _decode_entry(self.backend.get(_backend_key(key)))
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            # re-insert to mark it as the most recently used
+            self._entries[key] = entry
+        return entry
+
+    def _store(self, key, entry):
+        if self.backend is not None:
+            # kept until evicted if it can be revalidated
+            self.backend.set(_backend_key(key), _encode_entry(entry),
+                             None if entry[2] else self.ttls[key[0]])
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[1])
+        self._entries[key] = entry
+        self.size += len(entry[1])
+        while (len(self._entries) > self.max_entries or
+               self.size > self.max_bytes):
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def _discard(self, key):
+        if self.backend is not None:
+            self.backend.delete(_backend_key(key))
+            return
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def get(self, key):
+        """Return the cached body of ``key``, or ``None``."""
+        entry = self._load(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None and not entry[2]:
+                self._discard(key)
+            # else kept for revalidation
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def stale(self, key):
+        """
+        Return ``(body, validators)`` of the expired response of ``key``,
+        or ``None`` if there is none with validators.
+        """
+        entry = self._load(key)
+        if entry is None or not entry[2]:
+            return None
+        return entry[1], entry[2]
+
+    def set(self, key, body, validators=None):
+        """
+        Store ``body`` as the response of ``key``. ``validators`` is a dict
+        with any of ``etag``, ``last_modified`` and ``since_id``.
+        """
+        if len(body) > self.max_bytes:
+            return
+        self._store(key, (time.time() + self.ttls[key[0]], body, validators))
+
+    def revalidated(self, key):
+        """Mark the stale response of ``key`` fresh again."""
+        entry = self._load(key)
+        if entry is not None:
+            self._store(key, (time.time() + self.ttls[key[0]],
+                              entry[1], entry[2]))
+            self.revalidations += 1
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """Return a dict of the cache counters."""
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "revalidations": self.revalidations,
+            "entries": len(self._entries),
+            "bytes": self.size,
+        }
+        if self.backend is not None:
+            stats["backend"] = self.backend.stats()
+        return stats
+
+
+def _backend_key(key):
+    path, access_token, query = key
+    return b"\0".join([b"response", path.encode("utf-8"),
+                       (access_token or "").encode("utf-8"),
+                       query.encode("utf-8")])
+
+
+# expires at, length of the validators
+_ENTRY_HEADER = struct.Struct("<dI")
+
+
+def _encode_entry(entry):
+    expires, body, validators = entry
+    encoded = escape.utf8(escape.json_encode(validators)) if validators else b""
+    return _ENTRY_HEADER.pack(expires, len(encoded)) + encoded + body
+
+
+def _decode_entry(value):
+    if value is None:
+        return None
+    expires, length = _ENTRY_HEADER.unpack_from(value)
+    start = _ENTRY_HEADER.size
+    validators = (escape.json_decode(value[start:start + length])
+                  if length else None)
+    return expires, value[start + length:], validators
+
+
+class RequestCoalescer(object):
+    """
+    Merges identical GET requests sent while one of them is in flight.
+
+    Put it in the application settings as ``weibo_request_coalescer``, the
+    requests joining an in-flight request wait for the response of that
+    request. ``coalesced`` counts the requests which did not go to the
+    network. Requests are only merged with requests of the same access
+    token, except for ``public_paths``, e.g. ``public_paths=PUBLIC_PATHS``.
+    The requests merged share the response, errors included, so a request
+    failed for an expired or rate limited token fails for all of them.
+    """
+
+    def __init__(self, public_paths=frozenset()):
+        self.public_paths = public_paths
+        self.coalesced = 0
+        self._pending = {}
+
+    def key(self, path, access_token, query):
+        if path in self.public_paths:
+            access_token = None
+        return request_key(path, access_token, query)
+
+    def join(self, key):
+        """
+        Return the future of the in-flight request of ``key``, or ``None``
+        if there is no such request.
+        """
+        future = self._pending.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+
+    def start(self, key, future):
+        """Mark the request of ``key`` in flight until ``future`` is done."""
+        self._pending[key] = future
+
+    def finish(self, key):
+        self._pending.pop(key, None)
+
+    def stats(self):
+        return {
+            "coalesced": self.coalesced,
+            "in_flight": len(self._pending),
+        }
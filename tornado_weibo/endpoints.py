@@ -0,0 +1,124 @@
+"""
+Registry of the Weibo APIs.
+
+Knows the HTTP method, the required parameters and the cacheability of each
+API, so that :func:`~tornado_weibo.auth.WeiboMixin.weibo_request` does not
+have to work them out for every request. APIs missing from the registry are
+sent as ``GET`` requests without checks.
+"""
+from urllib.parse import quote, urlencode
+from tornado import escape
+
+
+class Endpoint(object):
+    """
+    An API of Weibo.
+
+    ``required`` lists the required parameters, a tuple in the list means
+    one of the parameters in it is required. Responses of ``cacheable``
+    APIs may be cached and coalesced.
+    """
+
+    __slots__ = ("path", "method", "required", "cacheable")
+
+    def __init__(self, path, method="GET", required=(), cacheable=None):
+        self.path = path
+        self.method = method
+        self.required = required
+        self.cacheable = method == "GET" if cacheable is None else cacheable
+
+    def missing_args(self, args):
+        """Return the required parameters missing from ``args``."""
+        missing = []
+        for names in self.required:
+            if isinstance(names, tuple):
+                if not any(name in args for name in names):
+                    missing.append(" or ".join(names))
+            elif names not in args:
+                missing.append(names)
+        return missing
+
+
+ENDPOINTS = dict((endpoint.path, endpoint) for endpoint in [
+    Endpoint("/account/get_uid"),
+    Endpoint("/users/show", required=[("uid", "screen_name")]),
+    Endpoint("/users/show_batch", required=[("uids", "screen_name")]),
+    Endpoint("/users/counts", required=["uids"]),
+    Endpoint("/statuses/public_timeline"),
+    Endpoint("/statuses/home_timeline"),
+    Endpoint("/statuses/friends_timeline"),
+    Endpoint("/statuses/user_timeline"),
+    Endpoint("/statuses/mentions"),
+    Endpoint("/statuses/repost_timeline", required=["id"]),
+    Endpoint("/statuses/show", required=["id"]),
+    Endpoint("/statuses/show_batch", required=["ids"]),
+    Endpoint("/statuses/count", required=["ids"]),
+    Endpoint("/comments/show", required=["id"]),
+    Endpoint("/comments/by_me"),
+    Endpoint("/comments/to_me"),
+    Endpoint("/comments/timeline"),
+    Endpoint("/favorites"),
+    Endpoint("/friendships/friends", required=[("uid", "screen_name")]),
+    Endpoint("/friendships/followers", required=[("uid", "screen_name")]),
+    Endpoint("/emotions"),
+    Endpoint("/statuses/update", "POST", required=["status"]),
+    Endpoint("/statuses/upload", "POST"),
+    Endpoint("/statuses/repost", "POST", required=["id"]),
+    Endpoint("/statuses/destroy", "POST", required=["id"]),
+    Endpoint("/comments/create", "POST", required=["id", "comment"]),
+    Endpoint("/comments/destroy", "POST", required=["cid"]),
+    Endpoint("/favorites/create", "POST", required=["id"]),
+    Endpoint("/favorites/destroy", "POST", required=["id"]),
+    Endpoint("/friendships/create", "POST", required=[("uid", "screen_name")]),
+    Endpoint("/friendships/destroy", "POST", required=[("uid", "screen_name")]),
+])
+
+# keys of the item lists in responses of timeline-like APIs
+ITEM_LIST_KEYS = ("statuses", "users", "comments", "reposts", "favorites")
+
+# (base url, path): url of the API
+_urls = {}
+
+
+def get_endpoint(path):
+    """
+    Return the :class:`Endpoint` of ``path``, a ``GET`` API without checks
+    if unknown. Unknown APIs are not added to the registry.
+    """
+    endpoint = ENDPOINTS.get(path)
+    if endpoint is None:
+        endpoint = Endpoint(path)
+    return endpoint
+
+
+def endpoint_url(base_url, path):
+    """Return the url of the API at ``path``, built once per known API."""
+    url = _urls.get((base_url, path))
+    if url is None:
+        url = base_url + "/2" + path + ".json"
+        if path in ENDPOINTS:
+            _urls[(base_url, path)] = url
+    return url
+
+
+def encode_args(args):
+    """
+    Return ``args`` as a query string, sorted by name so that the same
+    arguments always give the same string, e.g. to be used as cache key.
+    ``uid=1`` and ``uid="1"`` give the same string as well.
+    """
+    items = []
+    for name, value in args.items():
+        if not isinstance(value, (bytes, str)):
+            value = str(value)
+        items.append((name, escape.utf8(value)))
+    items.sort()
+    return urlencode(items)
+
+
+def with_access_token(query, access_token):
+    """Return ``query`` with ``access_token`` prepended."""
+    if not access_token:
+        return query
+    token = "access_token=" + quote(escape.utf8(access_token), safe="")
+    return token + "&" + query if query else token
@@ -0,0 +1,238 @@
+"""
+Metrics of Weibo API calls.
+
+Put a :class:`WeiboStats` in the application settings as ``weibo_stats`` to
+record the latency, status codes and sizes of every request sent to Weibo,
+per API, along with the outcomes of the response cache, request coalescing,
+rate limiting, retries and circuit breaking. The stats can be exposed with
+:class:`WeiboStatsHandler`::
+
+    stats = WeiboStats()
+    settings = {
+        "weibo_app_key": "",
+        "weibo_app_secret": "",
+        "weibo_stats": stats,
+    }
+    application = tornado.web.Application([
+        (r"/metrics", WeiboStatsHandler, {"stats": stats}),
+    ], **settings)
+"""
+import bisect
+from tornado import escape
+from tornado import web
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, float("inf"))
+
+# phases in HTTPResponse.time_info (only provided by the curl client)
+# recorded as histograms: DNS lookup, TCP connect, TLS handshake and time
+# to first byte, all measured from the start of the request
+TIME_INFO_PHASES = ("namelookup", "connect", "appconnect", "starttransfer")
+
+
+def _format_labels(labels):
+    return ",".join('%s="%s"' % label for label in labels)
+
+
+class Histogram(object):
+    """A cumulative histogram with the bounds of ``LATENCY_BUCKETS``."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return a list of ``(upper bound, observations <= bound)``."""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the ``q`` quantile."""
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class EndpointStats(object):
+    """The stats of one API."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.codes = {}
+        self.events = {}
+        self.latency = Histogram()
+        self.phases = {}
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "codes": dict((str(code), count)
+                          for code, count in self.codes.items()),
+            "events": dict(self.events),
+            "latency": self.latency.to_dict(),
+            "phases": dict((phase, histogram.to_dict())
+                           for phase, histogram in self.phases.items()),
+        }
+
+
+class WeiboStats(object):
+    """
+    Collects the stats of the Weibo API calls, per API path.
+
+    ``hooks`` are called with ``(endpoint, request, response)`` after every
+    response and ``event_hooks`` with ``(endpoint, event)`` after every
+    event, e.g. ``"cache_hit"``, so the stats can be forwarded to other
+    monitoring systems as well.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.hooks = []
+        self.event_hooks = []
+
+    def _endpoint(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        return stats
+
+    def record_fetch(self, endpoint, request, response):
+        """Record a response of ``endpoint``."""
+        stats = self._endpoint(endpoint)
+        stats.requests += 1
+        if response.error is not None and response.code != 304:
+            stats.errors += 1
+        stats.codes[response.code] = stats.codes.get(response.code, 0) + 1
+        stats.bytes_in += len(response.body or b"")
+        if request.body is not None:
+            stats.bytes_out += len(request.body)
+        elif "Content-Length" in request.headers:
+            stats.bytes_out += int(request.headers["Content-Length"])
+        if response.request_time is not None:
+            stats.latency.observe(response.request_time)
+        for phase in TIME_INFO_PHASES:
+            value = (response.time_info or {}).get(phase)
+            if value:
+                histogram = stats.phases.get(phase)
+                if histogram is None:
+                    histogram = stats.phases[phase] = Histogram()
+                histogram.observe(value)
+        for hook in self.hooks:
+            hook(endpoint, request, response)
+
+    def record_event(self, endpoint, event):
+        """
+        Record an event of ``endpoint``, one of ``cache_hit``,
+        ``cache_miss``, ``revalidated``, ``merged``, ``coalesced``,
+        ``rate_limited``, ``circuit_open``, ``retry`` and
+        ``login_cache_hit``.
+        """
+        events = self._endpoint(endpoint).events
+        events[event] = events.get(event, 0) + 1
+        for hook in self.event_hooks:
+            hook(endpoint, event)
+
+    def to_dict(self):
+        return dict((endpoint, stats.to_dict())
+                    for endpoint, stats in self.endpoints.items())
+
+    def to_json(self):
+        return escape.json_encode(self.to_dict())
+
+    def to_prometheus(self):
+        """Return the stats in the Prometheus text format."""
+        lines = []
+
+        def add(name, kind, help, samples):
+            lines.append("# HELP weibo_%s %s" % (name, help))
+            lines.append("# TYPE weibo_%s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("weibo_%s{%s} %s" % (name,
+                    _format_labels(labels), value))
+
+        def histogram_samples(endpoint, histogram, extra=()):
+            labels = (("endpoint", endpoint),) + tuple(extra)
+            for bound, total in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield ("bucket", labels + (("le", le),), total)
+            yield ("sum", labels, histogram.sum)
+            yield ("count", labels, histogram.count)
+
+        endpoints = sorted(self.endpoints.items())
+        add("requests_total", "counter", "Requests sent to Weibo.",
+            [((("endpoint", e),), s.requests) for e, s in endpoints])
+        add("errors_total", "counter", "Requests which failed.",
+            [((("endpoint", e),), s.errors) for e, s in endpoints])
+        add("responses_total", "counter", "Responses by status code.",
+            [((("endpoint", e), ("code", code)), count)
+             for e, s in endpoints for code, count in sorted(s.codes.items())])
+        add("received_bytes_total", "counter", "Bytes of response bodies.",
+            [((("endpoint", e),), s.bytes_in) for e, s in endpoints])
+        add("sent_bytes_total", "counter", "Bytes of request bodies.",
+            [((("endpoint", e),), s.bytes_out) for e, s in endpoints])
+        add("events_total", "counter",
+            "Cache, coalescing, rate limit, retry and circuit events.",
+            [((("endpoint", e), ("event", event)), count)
+             for e, s in endpoints for event, count in sorted(s.events.items())])
+        lines.append("# HELP weibo_request_seconds Latency of requests.")
+        lines.append("# TYPE weibo_request_seconds histogram")
+        for e, s in endpoints:
+            for suffix, labels, value in histogram_samples(e, s.latency):
+                lines.append("weibo_request_seconds_%s{%s} %s" % (suffix,
+                    _format_labels(labels), value))
+        lines.append("# HELP weibo_phase_seconds Time from the start of "
+                     "requests to the end of each phase.")
+        lines.append("# TYPE weibo_phase_seconds histogram")
+        for e, s in endpoints:
+            for phase, histogram in sorted(s.phases.items()):
+                for suffix, labels, value in histogram_samples(e, histogram,
+                        (("phase", phase),)):
+                    lines.append("weibo_phase_seconds_%s{%s} %s" % (suffix,
+                        _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+class WeiboStatsHandler(web.RequestHandler):
+    """
+    Serves the stats in the Prometheus text format, or as JSON with
+    ``?format=json``.
+    """
+
+    def initialize(self, stats):
+        self.stats = stats
+
+    def get(self):
+        if self.get_argument("format", None) == "json":
+            self.set_header("Content-Type", "application/json")
+            self.write(self.stats.to_json())
+            return
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.stats.to_prometheus())
@@ -0,0 +1,189 @@
+"""
+Compact models of Weibo users and statuses.
+
+Pass ``model=WeiboStatus`` or ``model=WeiboUser`` to
+:func:`~tornado_weibo.auth.WeiboMixin.weibo_request` to get models instead
+of dicts, e.g. for timelines held in memory::
+
+    timeline = yield self.weibo_request("/statuses/home_timeline",
+        access_token=access_token, model=WeiboStatus)
+    for status in timeline["statuses"]:
+        print(status.user.screen_name, status.text)
+
+Models keep the common keys in ``__slots__`` and any other key in a dict.
+They support ``model["key"]`` and ``model.get("key")`` like the dicts they
+replace. The ``user`` and ``retweeted_status`` of a status are built when
+first accessed and the statuses of a response share one model per user.
+"""
+import itertools
+from tornado_weibo.endpoints import ITEM_LIST_KEYS
+
+_anonymous = itertools.count()
+# the value of a key missing from the data, keys set to null are None
+_UNSET = object()
+
+
+class WeiboModel(object):
+    """Base class of the models, ``_fields`` are kept in ``__slots__``."""
+
+    __slots__ = ("_extra",)
+    _fields = ()
+    _field_set = frozenset()
+    _nested = ()
+
+    def __init__(self, data):
+        extra = None
+        fields = self._field_set
+        for key, value in data.items():
+            if key in fields:
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self._extra = extra
+
+    def __getattr__(self, name):
+        # unset slots read as None
+        if name in self._field_set:
+            return None
+        raise AttributeError(name)
+
+    def _get(self, key):
+        # the value of key, _UNSET if it was missing from the data
+        if key in self._field_set:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                return _UNSET
+        if self._extra is not None:
+            return self._extra.get(key, _UNSET)
+        return _UNSET
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is _UNSET:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """Return the model as the dict it was built from."""
+        result = dict(self._extra or {})
+        for key in self._fields + self._nested:
+            value = self._get(key)
+            if isinstance(value, WeiboModel):
+                value = value.to_dict()
+            if value is not _UNSET:
+                result[key] = value
+        return result
+
+    def __repr__(self):
+        return "%s(id=%r)" % (self.__class__.__name__, self.id)
+
+
+class WeiboUser(WeiboModel):
+    """A user."""
+
+    _fields = ("id", "idstr", "screen_name", "name", "province", "city",
+               "location", "description", "url", "profile_image_url",
+               "avatar_large", "domain", "gender", "followers_count",
+               "friends_count", "statuses_count", "favourites_count",
+               "created_at", "verified", "access_token")
+    __slots__ = _fields
+    _field_set = frozenset(_fields)
+    _nested = ()
+
+
+class WeiboStatus(WeiboModel):
+    """
+    A status. ``user`` and ``retweeted_status`` are built on first access,
+    statuses built together share the models of their users.
+    """
+
+    _fields = ("id", "idstr", "mid", "created_at", "text", "source",
+               "favorited", "truncated", "thumbnail_pic", "bmiddle_pic",
+               "original_pic", "pic_urls", "geo", "reposts_count",
+               "comments_count", "attitudes_count")
+    __slots__ = _fields + ("_user", "_retweeted", "_users")
+    _field_set = frozenset(_fields)
+    _nested = ("user", "retweeted_status")
+
+    def __init__(self, data, users=None):
+        data = dict(data)
+        user = data.pop("user", _UNSET)
+        self._retweeted = data.pop("retweeted_status", _UNSET)
+        WeiboModel.__init__(self, data)
+        self._users = users if users is not None else {}
+        # the key of the user in _users, or the user if None or _UNSET
+        self._user = user
+        if user is not None and user is not _UNSET:
+            # users are kept raw, once per id, until accessed
+            key = user.get("id") if not isinstance(user, WeiboUser) else user.id
+            if key is None:
+                key = (None, next(_anonymous))
+            self._users.setdefault(key, user)
+            self._user = key
+
+    def _get(self, key):
+        if key == "user":
+            return _UNSET if self._user is _UNSET else self.user
+        if key == "retweeted_status":
+            return _UNSET if self._retweeted is _UNSET else \
+                self.retweeted_status
+        return WeiboModel._get(self, key)
+
+    @property
+    def user(self):
+        if self._user is None or self._user is _UNSET:
+            return None
+        user = self._users[self._user]
+        if not isinstance(user, WeiboUser):
+            user = self._users[self._user] = WeiboUser(user)
+        return user
+
+    @property
+    def retweeted_status(self):
+        retweeted = self._retweeted
+        if retweeted is _UNSET:
+            return None
+        if retweeted is not None and not isinstance(retweeted, WeiboStatus):
+            retweeted = self._retweeted = WeiboStatus(retweeted, self._users)
+        return retweeted
+
+
+def build(model, value):
+    """
+    Build ``model`` from a decoded response. For responses with a list of
+    items, e.g. ``statuses`` of a timeline, the items are built and the
+    other keys of the response are kept.
+    """
+    if isinstance(value, list):
+        users = {}
+        return [_build_one(model, item, users) for item in value]
+    if not isinstance(value, dict):
+        return value
+    for key in ITEM_LIST_KEYS:
+        if isinstance(value.get(key), list):
+            result = dict(value)
+            result[key] = build(model, value[key])
+            return result
+    return _build_one(model, value, {})
+
+
+def _build_one(model, data, users):
+    if issubclass(model, WeiboStatus):
+        return model(data, users)
+    return model(data)
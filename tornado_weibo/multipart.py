@@ -0,0 +1,159 @@
+"""
+``multipart/form-data`` bodies of ``/statuses/upload``.
+
+Loaded on the first upload, see
+:func:`~tornado_weibo.auth.WeiboMixin.weibo_request`.
+"""
+import os
+import mmap
+import binascii
+from tornado import escape
+from tornado import gen
+
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# leading bytes of the picture formats accepted by /statuses/upload
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def is_file(body):
+    # mmap has read() too, but is sent as a buffer without copying
+    return hasattr(body, "read") and not isinstance(body, mmap.mmap)
+
+
+def body_size(body):
+    """Return the bytes left in ``body``, without reading any file."""
+    if not is_file(body):
+        return len(memoryview(body))
+    try:
+        size = os.fstat(body.fileno()).st_size
+    except (AttributeError, OSError):
+        # not a real file, e.g. a BytesIO
+        position = body.tell()
+        body.seek(0, os.SEEK_END)
+        size = body.tell()
+        body.seek(position)
+        return size - position
+    return size - body.tell()
+
+
+def sniff_image(body):
+    """Return the mime type of the picture ``body``, or ``None``."""
+    if is_file(body):
+        position = body.tell()
+        head = body.read(8)
+        body.seek(position)
+    else:
+        head = memoryview(body)[:8].tobytes()
+    for signature, mime_type in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    return None
+
+
+class MultiPartForm(object):
+    """Helper class to build a multipart form
+
+    This part was copied from http://www.doughellmann.com/PyMOTW/urllib2/
+    """
+
+    def __init__(self):
+        self.form_fields = []
+        self.files = []
+        self.boundary = binascii.hexlify(os.urandom(16)).decode("ascii")
+        return
+
+    def get_content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def add_field(self, name, value):
+        """Add a simple field to the form data."""
+        self.form_fields.append((name, value))
+        return
+
+    def add_file(self, fieldname, filename, body, mimetype):
+        """
+        Add a file to be uploaded.
+
+        ``body`` may be a string, any object supporting the buffer protocol
+        (e.g. a ``memoryview`` or an ``mmap``) or a file object opened in
+        binary mode. File objects are read from their current position when
+        the form is sent.
+        """
+        self.files.append((fieldname, filename, mimetype, body))
+        return
+
+    def _iter_parts(self):
+        """Yield the form data as byte strings and file bodies."""
+        part_boundary = '--' + self.boundary
+
+        # Add the form fields
+        for name, value in self.form_fields:
+            yield escape.utf8('\r\n'.join([
+                part_boundary,
+                'Content-Disposition: form-data; name="%s"' % name,
+                '',
+                '',
+            ])) + escape.utf8(value or '') + b'\r\n'
+
+        # Add the files to upload
+        for field_name, filename, content_type, body in self.files:
+            yield escape.utf8('\r\n'.join([
+                part_boundary,
+                'Content-Disposition: form-data; name="%s"; filename="%s"' %\
+                (field_name, filename),
+                'Content-Type: %s' % content_type,
+                '',
+                '',
+            ]))
+            yield body
+            yield b'\r\n'
+
+        # Add closing boundary marker
+        yield escape.utf8('--' + self.boundary + '--\r\n')
+
+    def get_content_length(self):
+        """Return the size of the form data without reading any file."""
+        return sum(body_size(part) for part in self._iter_parts())
+
+    def iter_chunks(self, chunk_size=_UPLOAD_CHUNK_SIZE):
+        """
+        Yield the form data in chunks of at most ``chunk_size`` bytes.
+
+        In-memory file bodies are yielded as ``memoryview`` slices and file
+        objects are read chunk by chunk, so file contents are never copied
+        into one big string.
+        """
+        for part in self._iter_parts():
+            if is_file(part):
+                while True:
+                    chunk = part.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                continue
+            view = memoryview(part)
+            for offset in range(0, len(view), chunk_size):
+                yield view[offset:offset + chunk_size]
+
+    @gen.coroutine
+    def body_producer(self, write):
+        """
+        Write the form data with ``write``, waiting for each chunk to be
+        sent. Use it as the ``body_producer`` of a
+        :class:`~tornado.httpclient.HTTPRequest`.
+        """
+        for chunk in self.iter_chunks():
+            yield write(chunk)
+
+    def __bytes__(self):
+        """Return a string representing the form data,
+        including attached files.
+        """
+        return b''.join(chunk if isinstance(chunk, bytes) else chunk.tobytes()
+                        for chunk in self.iter_chunks())
@@ -0,0 +1,134 @@
+"""
+Paging through timelines, comments and followers.
+
+:func:`~tornado_weibo.auth.WeiboMixin.weibo_paginate` returns a
+:class:`WeiboPaginator` which requests the pages one after another, only the
+current page and the next one are kept in memory::
+
+    pager = self.weibo_paginate("/statuses/user_timeline",
+        access_token=access_token, uid=uid, count=100)
+    async for status in pager:
+        ...
+
+With ``yield`` based coroutines use :func:`WeiboPaginator.next`::
+
+    while True:
+        status = yield pager.next()
+        if status is None:
+            break
+"""
+import collections
+from tornado import gen
+
+
+class WeiboPaginator(object):
+    """
+    Iterates over the items, or the pages if ``pages`` is set, of a
+    paginated API.
+
+    ``paging`` is ``"cursor"`` for APIs paged with ``cursor`` and
+    ``next_cursor``, ``"max_id"`` for APIs paged by asking for items older
+    than the last one, or ``"page"`` for APIs paged by page number, which
+    stop at the first page shorter than ``count``, or than the first page
+    if ``count`` is not given. If ``prefetch`` is set the next page is
+    requested while the current one is consumed. The iteration stops after
+    ``max_pages`` pages, or before the first item (or page) for which
+    ``until`` returns ``True``. If a request fails the iteration stops and
+    ``failed`` is set.
+    """
+
+    def __init__(self, handler, path, paging, items_key, access_token=None,
+                 args=None, pages=False, prefetch=True, until=None,
+                 max_pages=None, background=False):
+        self.path = path
+        self.paging = paging
+        self.items_key = items_key
+        self.pages = pages
+        self.prefetch = prefetch
+        self.until = until
+        self.max_pages = max_pages
+        self.pages_fetched = 0
+        self.failed = False
+        self._handler = handler
+        self._access_token = access_token
+        self._args = dict(args or {})
+        self._page_size = (int(self._args["count"]) if "count" in self._args
+                           else None)
+        self._background = background
+        self._buffer = collections.deque()
+        self._next_page = None
+        self._done = False
+
+    def _fetch(self):
+        self.pages_fetched += 1
+        return self._handler.weibo_request(self.path,
+            access_token=self._access_token, background=self._background,
+            **self._args)
+
+    def _on_page(self, response):
+        if response is None:
+            self.failed = True
+            self._done = True
+            return
+        items = response.get(self.items_key) or []
+        if not items:
+            self._done = True
+        elif self.paging == "cursor":
+            if response.get("next_cursor"):
+                self._args["cursor"] = response["next_cursor"]
+            else:
+                self._done = True
+        elif self.paging == "page":
+            if self._page_size is None:
+                self._page_size = len(items)
+            if len(items) < self._page_size:
+                self._done = True
+            else:
+                self._args["page"] = int(self._args.get("page", 1)) + 1
+        else:
+            self._args["max_id"] = min(int(item["id"]) for item in items) - 1
+        if self.max_pages is not None and self.pages_fetched >= self.max_pages:
+            self._done = True
+        if not self._done and self.prefetch:
+            self._next_page = self._fetch()
+        if self.pages:
+            if items:
+                self._buffer.append(items)
+        else:
+            self._buffer.extend(items)
+
+    @gen.coroutine
+    def next(self):
+        """
+        Return a :class:`~tornado.concurrent.Future` of the next item (or
+        page), ``None`` when there are no more.
+        """
+        while not self._buffer:
+            if self._done and self._next_page is None:
+                raise gen.Return(None)
+            if self._next_page is None:
+                self._next_page = self._fetch()
+            response = yield self._next_page
+            self._next_page = None
+            self._on_page(response)
+        item = self._buffer.popleft()
+        if self.until is not None and self.until(item):
+            self.stop()
+            raise gen.Return(None)
+        raise gen.Return(item)
+
+    def stop(self):
+        """Stop the iteration, a prefetched page is dropped."""
+        self._done = True
+        self._next_page = None
+        self._buffer.clear()
+
+    def __aiter__(self):
+        return self
+
+    @gen.coroutine
+    def __anext__(self):
+        item = yield self.next()
+        if item is None:
+            raise StopAsyncIteration()
+        raise gen.Return(item)
@@ -0,0 +1,312 @@
+"""
+Publishing statuses on behalf of many users.
+
+:class:`PublishQueue` sends ``/statuses/update`` and ``/statuses/upload``
+posts with a bounded number of posts in flight, per access token and in
+total. The posts of an access token are sent in the order they were queued.
+Pending posts are kept in a journal until they are done, so the posts left
+by a crash can be sent again::
+
+    queue = PublishQueue(WeiboClient(settings), SQLiteJournal("publish.db"))
+    yield queue.recover()
+    post = yield queue.post(access_token, status="Hello")
+    if post.state == "sent":
+        print(post.result["id"])
+"""
+import json
+import logging
+import sqlite3
+import itertools
+import collections
+from tornado.concurrent import Future
+from tornado import escape
+from tornado import gen
+from tornado import locks
+from tornado_weibo.retry import RetryPolicy
+
+# Weibo refuses the same text posted again by a user
+DUPLICATE_ERRORS = frozenset([20017, 20019, 20111])
+
+
+class MemoryJournal(object):
+    """Keeps the pending posts in memory, they are lost by a crash."""
+
+    persistent = False
+
+    def __init__(self):
+        self._posts = collections.OrderedDict()
+        self._ids = itertools.count(1)
+
+    @gen.coroutine
+    def add(self, access_token, path, args):
+        """Keep a post, returns the id of the post in the journal."""
+        id = next(self._ids)
+        self._posts[id] = (access_token, path, args)
+        raise gen.Return(id)
+
+    @gen.coroutine
+    def remove(self, id):
+        self._posts.pop(id, None)
+
+    @gen.coroutine
+    def pending(self):
+        """Return a list of ``(id, access_token, path, args)``, oldest first."""
+        raise gen.Return([(id,) + post for id, post in self._posts.items()])
+
+
+class SQLiteJournal(object):
+    """
+    Keeps the pending posts in a SQLite database at ``path``. Arguments are
+    stored as JSON, pictures must be given by ``path``.
+    """
+
+    persistent = True
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS weibo_publish_journal ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "access_token TEXT, path TEXT, args TEXT)")
+        self._db.commit()
+
+    @gen.coroutine
+    def add(self, access_token, path, args):
+        cursor = self._db.execute(
+            "INSERT INTO weibo_publish_journal (access_token, path, args) "
+            "VALUES (?, ?, ?)", (access_token, path, json.dumps(args)))
+        self._db.commit()
+        raise gen.Return(cursor.lastrowid)
+
+    @gen.coroutine
+    def remove(self, id):
+        self._db.execute("DELETE FROM weibo_publish_journal WHERE id = ?",
+                         (id,))
+        self._db.commit()
+
+    @gen.coroutine
+    def pending(self):
+        rows = self._db.execute(
+            "SELECT id, access_token, path, args FROM weibo_publish_journal "
+            "ORDER BY id").fetchall()
+        raise gen.Return([(id, access_token, path, json.loads(args))
+                          for id, access_token, path, args in rows])
+
+    def close(self):
+        self._db.close()
+
+
+class Post(object):
+    """
+    A post of :class:`PublishQueue`.
+
+    ``state`` is ``"pending"`` until the post is done, then ``"sent"`` with
+    the new status in ``result``, ``"duplicate"`` if Weibo refused it as
+    posted already, or ``"failed"`` with the Weibo error code, if any, in
+    ``error_code``.
+    """
+
+    def __init__(self, access_token, path, args):
+        self.access_token = access_token
+        self.path = path
+        self.args = args
+        self.state = "pending"
+        self.result = None
+        self.error_code = None
+        self.attempts = 0
+        self.future = Future()
+        self._journaled = None
+        # a picture given as a file object is read to the end by each
+        # attempt, it is sent again from _offset, None if it can not seek
+        self._file = None
+        self._offset = None
+        pic = args.get("pic")
+        if pic is not None and pic.get("content") is not None:
+            from tornado_weibo.multipart import is_file
+            if is_file(pic["content"]):
+                self._file = pic["content"]
+                seekable = getattr(self._file, "seekable", None)
+                if seekable is not None and seekable():
+                    self._offset = self._file.tell()
+
+    def _rewind(self):
+        # get the post ready to be sent again, False if it can not be
+        if self._file is None:
+            return True
+        if self._offset is None:
+            return False
+        self._file.seek(self._offset)
+        return True
+
+
+class PublishQueue(object):
+    """
+    Sends posts with at most ``concurrency`` in flight in total and at most
+    ``per_token`` in flight per access token.
+
+    ``client`` is anything with the :class:`~tornado_weibo.auth.WeiboMixin`
+    methods, e.g. a :class:`~tornado_weibo.auth.WeiboClient`. Posts failed
+    for a transient reason are sent again as ``retry_policy`` says. Posts
+    refused as duplicates are never sent again, a duplicate after a retry
+    usually means the first attempt went through. Pictures given as file
+    objects which can not seek are never sent again. With ``per_token`` above
+    1 the posts of a token are started in order but may finish out of order.
+    """
+
+    def __init__(self, client, journal=None, concurrency=10, per_token=1,
+                 retry_policy=None):
+        self.client = client
+        self.journal = journal or MemoryJournal()
+        self.concurrency = concurrency
+        self.per_token = per_token
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.sent = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.in_flight = 0
+        self._lanes = {}
+        self._workers = {}
+        self._semaphore = locks.Semaphore(concurrency)
+        self._done = locks.Condition()
+
+    def post(self, access_token, status, pic=None, **args):
+        """
+        Queue a post of ``status``, to ``/statuses/upload`` if ``pic`` is
+        given (see :func:`~tornado_weibo.auth.WeiboMixin.weibo_request`),
+        else to ``/statuses/update``. Anything in the keyword arguments is
+        sent along. Returns a :class:`~tornado.concurrent.Future` of the
+        :class:`Post`, resolved once it is done.
+        """
+        args["status"] = status
+        path = "/statuses/update"
+        if pic is not None:
+            if self.journal.persistent and "path" not in pic:
+                raise ValueError("Journaled pictures must be given by path")
+            args["pic"] = pic
+            path = "/statuses/upload"
+        post = Post(access_token, path, args)
+        post._journaled = self.journal.add(access_token, path, args)
+        self._queue(post)
+        return post.future
+
+    @gen.coroutine
+    def recover(self):
+        """
+        Queue the posts left in the journal, e.g. by a crash. Call it before
+        queueing new posts. Returns a list of the futures of the posts.
+        """
+        pending = yield self.journal.pending()
+        futures = []
+        for id, access_token, path, args in pending:
+            post = Post(access_token, path, args)
+            post._journaled = Future()
+            post._journaled.set_result(id)
+            self._queue(post)
+            futures.append(post.future)
+        raise gen.Return(futures)
+
+    def _queue(self, post):
+        lane = self._lanes.setdefault(post.access_token, collections.deque())
+        lane.append(post)
+        if self._workers.get(post.access_token, 0) < self.per_token:
+            self._workers[post.access_token] = (
+                self._workers.get(post.access_token, 0) + 1)
+            self._work(post.access_token)
+
+    @gen.coroutine
+    def _work(self, access_token):
+        lane = self._lanes[access_token]
+        try:
+            while lane:
+                post = lane.popleft()
+                yield self._send(post)
+        finally:
+            if lane:
+                # stopped by an error, a new worker sends the posts left
+                self._work(access_token)
+            else:
+                self._workers[access_token] -= 1
+                if not self._workers[access_token]:
+                    del self._workers[access_token]
+                    del self._lanes[access_token]
+                    self._done.notify_all()
+
+    @gen.coroutine
+    def _send(self, post):
+        # never raises, the future of the post is always resolved
+        id = None
+        try:
+            id = yield post._journaled
+            yield self._attempt(post)
+        except Exception:
+            logging.exception("Post to %s failed", post.path)
+            post.state = "failed"
+        if post.state == "sent":
+            self.sent += 1
+        elif post.state == "duplicate":
+            self.duplicates += 1
+        else:
+            self.failed += 1
+        if id is not None:
+            try:
+                yield self.journal.remove(id)
+            except Exception:
+                logging.exception("Removing post %s from the journal failed",
+                                  id)
+        post.future.set_result(post)
+
+    @gen.coroutine
+    def _attempt(self, post):
+        policy = self.retry_policy
+        while True:
+            post.attempts += 1
+            with (yield self._semaphore.acquire()):
+                self.in_flight += 1
+                try:
+                    response = yield self.client.weibo_request(post.path,
+                        access_token=post.access_token, raw=True, **post.args)
+                finally:
+                    self.in_flight -= 1
+            if response is None:
+                # not sent, e.g. a picture too large
+                post.state = "failed"
+                return
+            if not response.error:
+                post.result = escape.json_decode(response.body)
+                post.state = "sent"
+                return
+            post.error_code = _error_code(response)
+            if post.error_code in DUPLICATE_ERRORS:
+                post.state = "duplicate"
+                return
+            if (not policy.should_retry(post.attempts, response) or
+                    not post._rewind()):
+                logging.warning("Post to %s failed with %s, body %s",
+                                post.path, response.error, response.body)
+                post.state = "failed"
+                return
+            policy.retries += 1
+            yield gen.sleep(policy.backoff(post.attempts))
+
+    @gen.coroutine
+    def join(self):
+        """Wait until all queued posts are done."""
+        while self._lanes:
+            yield self._done.wait()
+
+    def stats(self):
+        """Return a dict of the queue counters."""
+        return {
+            "queued": sum(len(lane) for lane in self._lanes.values()),
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+        }
+
+
+def _error_code(response):
+    try:
+        return escape.json_decode(response.body).get("error_code")
+    except (ValueError, AttributeError, TypeError):
+        return None
@@ -0,0 +1,186 @@
+"""
+Client side rate limiting of Weibo API calls.
+
+Weibo limits the number of API calls per access token, per app key and per
+API in an hour, requests over the limit are rejected with ``403``. Put a
+:class:`RateLimiter` in the application settings as ``weibo_rate_limiter``
+and :func:`~tornado_weibo.auth.WeiboMixin.weibo_request` delays requests
+until the limits allow them instead::
+
+    settings = {
+        "weibo_app_key": "",
+        "weibo_app_secret": "",
+        "weibo_rate_limiter": RateLimiter(app_limit=(10000, 3600)),
+    }
+
+Requests sent with ``background=True`` may not use the part of the app
+budget reserved for interactive requests, so background jobs can never
+starve user logins.
+"""
+import time
+from tornado import escape
+from tornado import gen
+
+# error codes of the "out of rate limit" errors, per IP, per user and
+# per user and API, see http://open.weibo.com/wiki/Error_code
+IP_LIMIT_ERROR = 10022
+USER_LIMIT_ERROR = 10023
+USER_PATH_LIMIT_ERROR = 10024
+
+# full buckets are dropped once there are more buckets than this
+_MAX_BUCKETS = 100000
+
+
+class TokenBucket(object):
+    """A bucket of ``capacity`` tokens refilled at ``rate`` tokens/second."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, reserve=0):
+        """
+        Return the seconds to wait until a token is available while
+        keeping ``reserve`` tokens in the bucket.
+        """
+        self._refill()
+        missing = reserve + 1 - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def drain(self):
+        """Empty the bucket, e.g. after Weibo says the limit is reached."""
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+
+    @property
+    def remaining(self):
+        self._refill()
+        return int(max(self.tokens, 0))
+
+
+class RateLimiter(object):
+    """
+    Token buckets per access token, per app key and per API.
+
+    Limits are ``(requests, seconds)`` tuples, ``None`` means no limit.
+    ``token_limit`` applies to each access token, ``app_limit`` to all
+    requests of the app and ``path_limits`` maps API paths to the limit of
+    each access token on that API. ``background_reserve`` is the part of
+    the app budget only interactive requests may use. Requests which would
+    have to wait longer than ``max_delay`` seconds are rejected.
+    """
+
+    def __init__(self, token_limit=(150, 3600), app_limit=None,
+                 path_limits=None, background_reserve=0.2, max_delay=30):
+        self.token_limit = token_limit
+        self.app_limit = app_limit
+        self.path_limits = path_limits or {}
+        self.background_reserve = background_reserve
+        self.max_delay = max_delay
+        self.rejected = 0
+        self._app_bucket = self._bucket(app_limit) if app_limit else None
+        self._buckets = {}
+
+    @staticmethod
+    def _bucket(limit):
+        requests, seconds = limit
+        return TokenBucket(requests, float(requests) / seconds)
+
+    def _get_buckets(self, access_token, path):
+        buckets = []
+        keys = []
+        if access_token and self.token_limit:
+            keys.append(((access_token, None), self.token_limit))
+        if access_token and path in self.path_limits:
+            keys.append(((access_token, path), self.path_limits[path]))
+        for key, limit in keys:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= _MAX_BUCKETS:
+                    self._prune()
+                bucket = self._buckets[key] = self._bucket(limit)
+            buckets.append(bucket)
+        return buckets
+
+    def _prune(self):
+        # a full bucket is the same as a new one
+        for key, bucket in list(self._buckets.items()):
+            if bucket.remaining >= bucket.capacity:
+                del self._buckets[key]
+
+    def _delay(self, access_token, path, background):
+        delay = 0
+        if self._app_bucket is not None:
+            reserve = 0
+            if background:
+                reserve = self._app_bucket.capacity * self.background_reserve
+            delay = self._app_bucket.delay(reserve)
+        for bucket in self._get_buckets(access_token, path):
+            delay = max(delay, bucket.delay())
+        return delay
+
+    @gen.coroutine
+    def acquire(self, access_token, path, background=False):
+        """
+        Wait until a request is allowed, returns ``False`` if the request
+        would have to wait for more than ``max_delay`` seconds.
+        """
+        deadline = time.time() + self.max_delay
+        while True:
+            delay = self._delay(access_token, path, background)
+            if not delay:
+                break
+            if time.time() + delay > deadline:
+                self.rejected += 1
+                raise gen.Return(False)
+            yield gen.sleep(delay)
+        if self._app_bucket is not None:
+            self._app_bucket.take()
+        for bucket in self._get_buckets(access_token, path):
+            bucket.take()
+        raise gen.Return(True)
+
+    def on_response(self, access_token, path, response):
+        """Drain the buckets if Weibo says a rate limit is reached."""
+        if response.code != 403 or not response.body:
+            return
+        try:
+            error_code = escape.json_decode(response.body).get("error_code")
+        except (ValueError, AttributeError):
+            return
+        if error_code == IP_LIMIT_ERROR and self._app_bucket is not None:
+            self._app_bucket.drain()
+        elif error_code == USER_LIMIT_ERROR and access_token:
+            for bucket in self._get_buckets(access_token, None):
+                bucket.drain()
+        elif (error_code == USER_PATH_LIMIT_ERROR and access_token and
+              path in self.path_limits):
+            self._get_buckets(access_token, path)[-1].drain()
+
+    def remaining(self, access_token=None, path=None):
+        """
+        Return the number of requests left, as a dict with ``app``,
+        ``token`` and ``path`` keys, ``None`` for unlimited ones.
+        """
+        result = {"app": None, "token": None, "path": None}
+        if self._app_bucket is not None:
+            result["app"] = self._app_bucket.remaining
+        if access_token and self.token_limit:
+            result["token"] = self._get_buckets(access_token, None)[0].remaining
+        if access_token and path in self.path_limits:
+            result["path"] = self._get_buckets(access_token, path)[-1].remaining
+        return result
@@ -0,0 +1,107 @@
+"""
+Retries and circuit breaking for transient Weibo API failures.
+
+Put a :class:`RetryPolicy` in the application settings as
+``weibo_retry_policy`` to retry idempotent requests (``GET`` requests and the
+OAuth2 token exchange) which failed with a connection error or a ``5xx``
+response. Put a :class:`CircuitBreaker` in the settings as
+``weibo_circuit_breaker`` to fail fast on APIs which keep failing::
+
+    settings = {
+        "weibo_app_key": "",
+        "weibo_app_secret": "",
+        "weibo_retry_policy": RetryPolicy(max_attempts=3),
+        "weibo_circuit_breaker": CircuitBreaker(),
+    }
+"""
+import time
+import random
+
+# connection errors and timeouts are reported as 599 by tornado
+TRANSIENT_CODES = frozenset([500, 502, 503, 504, 599])
+
+
+def is_transient(response):
+    """Return ``True`` if ``response`` failed for a reason worth retrying."""
+    return response.error is not None and response.code in TRANSIENT_CODES
+
+
+class RetryPolicy(object):
+    """
+    Retry with jittered exponential backoff.
+
+    A request is sent at most ``max_attempts`` times, each attempt times out
+    after ``attempt_timeout`` seconds. Before the n-th retry it waits a
+    random time between 0 and ``min(max_delay, base_delay * 2 ** n)``
+    seconds.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.1, max_delay=2.0,
+                 attempt_timeout=10):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.retries = 0
+
+    def should_retry(self, attempt, response):
+        """Return ``True`` if the ``attempt``-th (from 1) attempt is retried."""
+        return attempt < self.max_attempts and is_transient(response)
+
+    def backoff(self, attempt):
+        """Return the seconds to wait before retrying after ``attempt``."""
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker per API path.
+
+    After ``failure_threshold`` consecutive transient failures of an API the
+    circuit opens and requests to the API fail immediately. After
+    ``reset_timeout`` seconds one trial request is let through, the circuit
+    closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.rejected = 0
+        # path: [consecutive failures, time the circuit opened or None]
+        self._circuits = {}
+
+    def allow(self, path):
+        """Return ``True`` if a request to ``path`` may be sent."""
+        circuit = self._circuits.get(path)
+        if circuit is None or circuit[1] is None:
+            return True
+        if time.time() - circuit[1] >= self.reset_timeout:
+            # half open, let one request through and wait for its result
+            circuit[1] = time.time()
+            return True
+        self.rejected += 1
+        return False
+
+    def record(self, path, response):
+        """Record the outcome of a request to ``path``."""
+        if not is_transient(response):
+            self._circuits.pop(path, None)
+            return
+        circuit = self._circuits.setdefault(path, [0, None])
+        circuit[0] += 1
+        if circuit[0] >= self.failure_threshold:
+            circuit[1] = time.time()
+
+    def state(self, path):
+        """Return ``"closed"``, ``"open"`` or ``"half-open"``."""
+        circuit = self._circuits.get(path)
+        if circuit is None or circuit[1] is None:
+            return "closed"
+        if time.time() - circuit[1] >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def open_circuits(self):
+        return sorted(path for path in self._circuits
+                      if self.state(path) != "closed")
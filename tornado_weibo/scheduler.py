@@ -0,0 +1,253 @@
+"""
+Polling many access tokens in background jobs.
+
+:class:`PollingScheduler` calls a job, e.g. :func:`TimelineSync.sync
+<tornado_weibo.sync.TimelineSync.sync>`, for every access token when it is
+due, with a bounded number of jobs running at the same time. The polling
+interval of each token adapts to its activity: it is halved after a poll
+which found something new and doubled after a poll which found nothing.
+
+:func:`run_sharded` splits the tokens across worker processes, each running
+its own scheduler on its own IOLoop. ``make_job`` is sent to the workers, so
+it is defined at module level::
+
+    def make_job():
+        return TimelineSync(WeiboClient(settings),
+                            SQLiteCheckpointStore("sync.db")).sync
+
+    if __name__ == "__main__":
+        run_sharded(access_tokens, make_job, processes=8, duration=3600,
+                    on_report=logging.info)
+"""
+import time
+import zlib
+import heapq
+import logging
+import datetime
+import itertools
+import multiprocessing
+from queue import Empty
+from tornado.ioloop import IOLoop
+from tornado import gen
+from tornado import locks
+
+
+class PollingScheduler(object):
+    """
+    Runs ``job(access_token)`` for every access token when it is due.
+
+    ``job`` returns a :class:`~tornado.concurrent.Future` (or coroutine) of
+    the activity found by the poll, a number or a list of new items. At most
+    ``concurrency`` jobs run at the same time, the interval of each token
+    stays between ``min_interval`` and ``max_interval`` seconds.
+    """
+
+    def __init__(self, job, concurrency=10, min_interval=60,
+                 max_interval=3600):
+        self.job = job
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.polls = 0
+        self.errors = 0
+        self.items = 0
+        self.in_flight = 0
+        # heap of (due time, sequence, access token)
+        self._heap = []
+        self._intervals = {}
+        self._sequence = itertools.count()
+        self._semaphore = locks.Semaphore(concurrency)
+        self._wakeup = locks.Event()
+        self._running = False
+
+    def _schedule(self, access_token, delay):
+        heapq.heappush(self._heap, (time.time() + delay,
+                                    next(self._sequence), access_token))
+        self._wakeup.set()
+
+    def add(self, access_token, interval=None, delay=0):
+        """Poll ``access_token`` in ``delay`` seconds and then regularly."""
+        if access_token in self._intervals:
+            return
+        self._intervals[access_token] = interval or self.min_interval
+        self._schedule(access_token, delay)
+
+    def remove(self, access_token):
+        """Stop polling ``access_token``."""
+        self._intervals.pop(access_token, None)
+
+    @gen.coroutine
+    def run(self, duration=None):
+        """
+        Poll the tokens until :func:`stop` is called or for ``duration``
+        seconds, then wait for the running jobs.
+        """
+        self._running = True
+        deadline = time.time() + duration if duration is not None else None
+        while self._running:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            wait = deadline - now if deadline is not None else None
+            if self._heap and self._heap[0][0] <= now:
+                _, _, access_token = heapq.heappop(self._heap)
+                if access_token not in self._intervals:
+                    continue
+                yield self._semaphore.acquire()
+                self._poll(access_token)
+                continue
+            if self._heap:
+                due = self._heap[0][0] - now
+                wait = due if wait is None else min(wait, due)
+            self._wakeup.clear()
+            try:
+                if wait is None:
+                    yield self._wakeup.wait()
+                else:
+                    yield self._wakeup.wait(datetime.timedelta(seconds=wait))
+            except gen.TimeoutError:
+                pass
+        self._running = False
+        # all jobs are done once all semaphore slots are free again
+        for _ in range(self.concurrency):
+            yield self._semaphore.acquire()
+        for _ in range(self.concurrency):
+            self._semaphore.release()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    @gen.coroutine
+    def _poll(self, access_token):
+        self.in_flight += 1
+        activity = 0
+        try:
+            result = yield self.job(access_token)
+            if isinstance(result, (list, tuple)):
+                activity = len(result)
+            else:
+                activity = result or 0
+        except Exception:
+            logging.exception("Polling job failed")
+            self.errors += 1
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+        self.polls += 1
+        self.items += activity
+        interval = self._intervals.get(access_token)
+        if interval is None:
+            return
+        if activity:
+            interval = max(self.min_interval, interval / 2.0)
+        else:
+            interval = min(self.max_interval, interval * 2.0)
+        self._intervals[access_token] = interval
+        self._schedule(access_token, interval)
+
+    def progress(self):
+        """Return a dict of the scheduler counters."""
+        now = time.time()
+        return {
+            "tokens": len(self._intervals),
+            "polls": self.polls,
+            "errors": self.errors,
+            "items": self.items,
+            "in_flight": self.in_flight,
+            "overdue": sum(1 for due, _, _ in self._heap if due < now),
+        }
+
+
+def shard(access_token, shards):
+    """Return the shard of ``access_token``, the same in every process."""
+    return zlib.crc32(access_token.encode("utf-8")) % shards
+
+
+def _run_shard(index, access_tokens, make_job, reports, report_interval,
+               duration, scheduler_args):
+    io_loop = IOLoop()
+    scheduler = PollingScheduler(make_job(), **scheduler_args)
+    # spread the first polls over the minimum interval
+    spread = float(scheduler.min_interval) / max(len(access_tokens), 1)
+    for i, access_token in enumerate(access_tokens):
+        scheduler.add(access_token, delay=i * spread)
+
+    @gen.coroutine
+    def report():
+        while scheduler._running:
+            reports.put((index, scheduler.progress()))
+            yield gen.sleep(report_interval)
+
+    @gen.coroutine
+    def main():
+        finished = scheduler.run(duration)
+        report()
+        yield finished
+        reports.put((index, scheduler.progress()))
+
+    try:
+        io_loop.run_sync(main)
+    finally:
+        reports.put((index, None))
+        io_loop.close()
+
+
+def run_sharded(access_tokens, make_job, processes=4, duration=None,
+                report_interval=10, on_report=None, **scheduler_args):
+    """
+    Poll ``access_tokens`` with ``processes`` worker processes.
+
+    ``make_job`` is called in each worker process and returns the job of the
+    :class:`PollingScheduler`, anything in the keyword arguments is passed to
+    the scheduler. Unless :mod:`multiprocessing` starts the workers with
+    ``fork``, ``make_job`` is pickled and must be a function defined at
+    module level, not a closure or a lambda. The workers run for
+    ``duration`` seconds, or forever if ``None``. Every ``report_interval``
+    seconds ``on_report`` is called with the progress of all workers summed
+    up, which is also returned when all workers have exited. This function
+    blocks and must not be called from a running IOLoop.
+    """
+    shards = [[] for _ in range(processes)]
+    for access_token in access_tokens:
+        shards[shard(access_token, processes)].append(access_token)
+    reports = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_run_shard, args=(i, tokens, make_job,
+            reports, report_interval, duration, scheduler_args))
+        for i, tokens in enumerate(shards)
+    ]
+    for worker in workers:
+        worker.start()
+
+    progress = {}
+    running = set(range(processes))
+    last_report = time.time()
+    while running:
+        try:
+            index, shard_progress = reports.get(timeout=report_interval)
+        except Empty:
+            # a worker killed before saying goodbye
+            running = set(i for i in running if workers[i].is_alive())
+        else:
+            if shard_progress is None:
+                running.discard(index)
+            else:
+                progress[index] = shard_progress
+        if on_report is not None and time.time() - last_report >= report_interval:
+            on_report(_sum_progress(progress))
+            last_report = time.time()
+    for worker in workers:
+        worker.join()
+    total = _sum_progress(progress)
+    if on_report is not None:
+        on_report(total)
+    return total
+
+
+def _sum_progress(progress):
+    total = {"workers": len(progress)}
+    for shard_progress in progress.values():
+        for key, value in shard_progress.items():
+            total[key] = total.get(key, 0) + value
+    return total
@@ -0,0 +1,226 @@
+"""
+Session stores keeping the access tokens and profiles of logged in users.
+
+Put a store in the application settings as ``weibo_session_store``,
+:func:`~tornado_weibo.auth.WeiboMixin.get_authenticated_user` then saves the
+session of each user who logs in, keyed by the user id. Only the user id has
+to be kept in a secure cookie, see
+:func:`~tornado_weibo.auth.WeiboMixin.get_current_weibo_user`::
+
+    settings = {
+        "weibo_app_key": "",
+        "weibo_app_secret": "",
+        "weibo_session_store": MemorySessionStore(),
+    }
+
+A session is a dict with ``uid``, ``access_token``, ``expires_at`` (unix
+time, ``None`` if unknown), ``refresh_token`` (if Weibo gave one) and
+``user``, the dict returned by ``get_authenticated_user``.
+
+The stores are asynchronous, all methods return a
+:class:`~tornado.concurrent.Future`, so a store backed by a network service
+can be plugged in by implementing :class:`SessionStore`.
+"""
+import time
+import sqlite3
+import collections
+from tornado import escape
+from tornado import gen
+
+
+def _expired(session, now=None):
+    expires_at = session.get("expires_at")
+    return expires_at is not None and expires_at <= (now or time.time())
+
+
+class SessionStore(object):
+    """The interface of session stores."""
+
+    def get(self, uid):
+        """Return the session of ``uid``, ``None`` if missing or expired."""
+        raise NotImplementedError()
+
+    def set(self, uid, session):
+        """Save ``session`` as the session of ``uid``."""
+        raise NotImplementedError()
+
+    def delete(self, uid):
+        """Remove the session of ``uid``."""
+        raise NotImplementedError()
+
+
+class MemorySessionStore(SessionStore):
+    """Keeps at most ``max_entries`` sessions in memory, LRU evicted."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._sessions = collections.OrderedDict()
+
+    @gen.coroutine
+    def get(self, uid):
+        session = self._sessions.pop(str(uid), None)
+        if session is None or _expired(session):
+            raise gen.Return(None)
+        self._sessions[str(uid)] = session
+        raise gen.Return(session)
+
+    @gen.coroutine
+    def set(self, uid, session):
+        self._sessions.pop(str(uid), None)
+        self._sessions[str(uid)] = session
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+
+    @gen.coroutine
+    def delete(self, uid):
+        self._sessions.pop(str(uid), None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keeps the sessions in a SQLite database at ``path``.
+
+    SQLite calls block the IOLoop, which is fine for a local file but this
+    store is mainly meant for development and small deployments.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS weibo_sessions ("
+                         "uid TEXT PRIMARY KEY, session TEXT, expires_at REAL)")
+        self._db.commit()
+
+    @gen.coroutine
+    def get(self, uid):
+        row = self._db.execute(
+            "SELECT session FROM weibo_sessions WHERE uid = ?",
+            (str(uid),)).fetchone()
+        if row is None:
+            raise gen.Return(None)
+        session = escape.json_decode(row[0])
+        if _expired(session):
+            raise gen.Return(None)
+        raise gen.Return(session)
+
+    @gen.coroutine
+    def set(self, uid, session):
+        self._db.execute(
+            "INSERT OR REPLACE INTO weibo_sessions VALUES (?, ?, ?)",
+            (str(uid), escape.json_encode(session), session.get("expires_at")))
+        self._db.commit()
+
+    @gen.coroutine
+    def delete(self, uid):
+        self._db.execute("DELETE FROM weibo_sessions WHERE uid = ?",
+                         (str(uid),))
+        self._db.commit()
+
+    def purge(self):
+        """Delete all expired sessions."""
+        self._db.execute("DELETE FROM weibo_sessions WHERE expires_at <= ?",
+                         (time.time(),))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class LoginCache(object):
+    """
+    Remembers the access token and profile of users who logged in lately,
+    so that a repeated login only exchanges the code for a token.
+
+    Put it in the application settings as ``weibo_login_cache``,
+    :func:`~tornado_weibo.auth.WeiboMixin.get_authenticated_user` then
+    answers the profile lookups of a user from the cache for ``max_age``
+    seconds. Profiles older than ``refresh_after`` seconds are still
+    answered from the cache but looked up again in the background. At most
+    ``max_entries`` users are kept, LRU evicted. If ``backend`` is given,
+    e.g. a :class:`~tornado_weibo.shared.SharedMemoryCache`, the users are
+    kept there instead and ``max_entries`` is up to the backend.
+    """
+
+    def __init__(self, max_age=300, refresh_after=60, max_entries=10000,
+                 backend=None):
+        self.max_age = max_age
+        self.refresh_after = refresh_after
+        self.max_entries = max_entries
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        # uid: (access token, expires at, profile, fetched at)
+        self._entries = collections.OrderedDict()
+
+    def _load(self, uid):
+        if self.backend is not None:
+            value = self.backend.get(b"login\0" + escape.utf8(str(uid)))
+            return tuple(escape.json_decode(value)) if value else None
+        entry = self._entries.pop(str(uid), None)
+        if entry is not None:
+            self._entries[str(uid)] = entry
+        return entry
+
+    def _store(self, uid, entry):
+        if self.backend is not None:
+            self.backend.set(b"login\0" + escape.utf8(str(uid)),
+                             escape.utf8(escape.json_encode(entry)),
+                             self.max_age)
+            return
+        self._entries.pop(str(uid), None)
+        self._entries[str(uid)] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, uid, keys=()):
+        """
+        Return ``(profile, refresh)`` of ``uid``, ``refresh`` is ``True`` if
+        the profile should be looked up again. Returns ``None`` if the user
+        is unknown, the profile is too old, the access token has expired or
+        the profile lacks any of ``keys``.
+        """
+        now = time.time()
+        entry = self._load(uid)
+        if (entry is None or now - entry[3] > self.max_age or
+                (entry[1] is not None and entry[1] <= now) or
+                not all(key in entry[2] for key in keys)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        refresh = now - entry[3] > self.refresh_after
+        if refresh:
+            self.refreshes += 1
+        return entry[2], refresh
+
+    def token(self, uid):
+        """Return ``(access_token, expires_at)`` of ``uid``, or ``None``."""
+        entry = self._load(uid)
+        return entry[:2] if entry is not None else None
+
+    def set(self, uid, access_token, expires_at, profile):
+        """Remember the profile of ``uid``, fetched just now."""
+        self._store(uid, (access_token, expires_at, profile, time.time()))
+
+    def set_token(self, uid, access_token, expires_at):
+        """Replace the access token of ``uid``, keeping the profile."""
+        entry = self._load(uid)
+        if entry is not None:
+            self._store(uid, (access_token, expires_at) + entry[2:])
+
+    def delete(self, uid):
+        if self.backend is not None:
+            self.backend.delete(b"login\0" + escape.utf8(str(uid)))
+        self._entries.pop(str(uid), None)
+
+    def stats(self):
+        """Return a dict of the cache counters."""
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "entries": len(self._entries),
+        }
+        if self.backend is not None:
+            stats["backend"] = self.backend.stats()
+        return stats
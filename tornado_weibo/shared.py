@@ -0,0 +1,271 @@
+"""
+A cache shared by all processes on a host.
+
+With :func:`tornado.process.fork_processes` each worker has its own
+:class:`~tornado_weibo.cache.ResponseCache` and
+:class:`~tornado_weibo.session.LoginCache`, so every worker warms up its own
+copy. :class:`SharedMemoryCache` keeps the entries in a memory-mapped file
+instead, create it before forking and pass it to the caches as ``backend``
+so all workers share one cache::
+
+    backend = SharedMemoryCache()
+    settings = {
+        "weibo_app_key": "",
+        "weibo_app_secret": "",
+        "weibo_response_cache": ResponseCache(backend=backend),
+        "weibo_login_cache": LoginCache(backend=backend),
+    }
+    tornado.process.fork_processes(0)
+
+Processes which are not forked from the same parent share the cache by
+opening the same ``path``. Only available on Unix, the entries are locked
+with ``fcntl``.
+"""
+import os
+import time
+import errno
+import mmap
+import fcntl
+import struct
+import hashlib
+import tempfile
+
+# slot size in bytes, number of slots; an entry goes to the smallest slots
+# it fits in, 32 MiB in total
+DEFAULT_CLASSES = ((2 * 1024, 8192), (16 * 1024, 512), (128 * 1024, 64))
+
+_MAGIC = b"TWSC0001"
+_HEADER_SIZE = 4096
+# key hash (0 if empty), expires at (0 if never), last used, key length,
+# value length
+_SLOT = struct.Struct("<QddII")
+
+
+def _reserve(fd, size):
+    # allocate the whole file now, a full tmpfs then fails here with ENOSPC
+    # instead of killing the process with SIGBUS on a write to the mapping
+    fallocate = getattr(os, "posix_fallocate", None)
+    if fallocate is not None:
+        try:
+            fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            # not supported by the file system
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+
+def _hash(key):
+    # the same in every process, unlike hash()
+    value = struct.unpack("<Q", hashlib.blake2b(key, digest_size=8).digest())[0]
+    return value or 1
+
+
+class SharedMemoryCache(object):
+    """
+    A LRU cache of byte strings in a memory-mapped file.
+
+    The file is split in ``classes`` of ``(slot size, number of slots)``,
+    each entry takes one slot of the smallest size it fits in, larger
+    entries are not cached. Slots are grouped by ``ways``, an entry can only
+    go to one group of its key and evicts the least recently used or
+    expired entry of that group. Every :func:`get` and :func:`set` locks the
+    group, so they are atomic across processes.
+
+    If ``path`` is ``None`` an unnamed file in ``/dev/shm`` is used, or in
+    the temporary directory if ``/dev/shm`` is missing or too small, e.g.
+    64 MiB in Docker. It is only shared with the processes forked after the
+    cache is created. The whole file is allocated up front, 32 MiB with the
+    default ``classes``, so a full file system raises :exc:`OSError` here
+    rather than crashing the workers later.
+    """
+
+    def __init__(self, path=None, classes=DEFAULT_CLASSES, ways=8):
+        self.classes = tuple((int(size), int(slots)) for size, slots in classes)
+        self.ways = ways
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+        header = _MAGIC + struct.pack("<II", ways, len(self.classes)) + \
+            b"".join(struct.pack("<II", size, slots)
+                     for size, slots in self.classes)
+        self._regions = []
+        offset = _HEADER_SIZE
+        for size, slots in self.classes:
+            groups = max(1, slots // ways)
+            self._regions.append((offset, size, groups))
+            offset += size * groups * ways
+        if path is None:
+            directories = [tempfile.gettempdir()]
+            if os.path.isdir("/dev/shm"):
+                directories.insert(0, "/dev/shm")
+            for directory in directories:
+                fd, path = tempfile.mkstemp(prefix="tornado_weibo-",
+                                            dir=directory)
+                os.unlink(path)
+                try:
+                    _reserve(fd, offset)
+                    break
+                except OSError as e:
+                    os.close(fd)
+                    if (e.errno != errno.ENOSPC or
+                            directory == directories[-1]):
+                        raise
+            self.path = None
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            self.path = path
+        self._fd = fd
+        fcntl.lockf(fd, fcntl.LOCK_EX, _HEADER_SIZE, 0)
+        try:
+            if self.path is not None:
+                _reserve(fd, offset)
+            self._map = mmap.mmap(fd, offset)
+            existing = self._map[:len(header)]
+            if existing[:len(_MAGIC)] != _MAGIC:
+                self._map[:len(header)] = header
+            elif existing != header:
+                raise ValueError("%s is a cache with other classes" % path)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, _HEADER_SIZE, 0)
+
+    def _group(self, region, key_hash):
+        offset, size, groups = region
+        start = offset + (key_hash % groups) * size * self.ways
+        return start, size
+
+    def _lock(self, start, size):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, size * self.ways, start)
+
+    def _unlock(self, start, size):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, size * self.ways, start)
+
+    def _find(self, start, size, key, key_hash):
+        # return the offset of the slot of key in the group, or None
+        for way in range(self.ways):
+            slot = start + way * size
+            slot_hash, _, _, key_length, _ = _SLOT.unpack_from(self._map, slot)
+            if (slot_hash == key_hash and key_length == len(key) and
+                    self._map[slot + _SLOT.size:
+                              slot + _SLOT.size + key_length] == key):
+                return slot
+        return None
+
+    def get(self, key):
+        """Return the value of ``key``, ``None`` if missing or expired."""
+        key_hash = _hash(key)
+        now = time.time()
+        for region in self._regions:
+            start, size = self._group(region, key_hash)
+            self._lock(start, size)
+            try:
+                slot = self._find(start, size, key, key_hash)
+                if slot is None:
+                    continue
+                _, expires, _, key_length, length = _SLOT.unpack_from(
+                    self._map, slot)
+                if expires and expires <= now:
+                    _SLOT.pack_into(self._map, slot, 0, 0, 0, 0, 0)
+                    break
+                _SLOT.pack_into(self._map, slot, key_hash, expires, now,
+                                key_length, length)
+                value_start = slot + _SLOT.size + key_length
+                self.hits += 1
+                return self._map[value_start:value_start + length]
+            finally:
+                self._unlock(start, size)
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        """
+        Store ``value`` as the value of ``key`` for ``ttl`` seconds, or
+        until evicted if ``ttl`` is ``None``. Returns ``False`` if the entry
+        is too large to be cached.
+        """
+        needed = _SLOT.size + len(key) + len(value)
+        target = None
+        for region in self._regions:
+            if region[1] >= needed:
+                target = region
+                break
+        self.delete(key, keep=target)
+        if target is None:
+            self.rejected += 1
+            return False
+        key_hash = _hash(key)
+        now = time.time()
+        start, size = self._group(target, key_hash)
+        self._lock(start, size)
+        try:
+            slot = self._find(start, size, key, key_hash)
+            if slot is None:
+                # an empty or expired slot, else the least recently used
+                victim = None
+                for way in range(self.ways):
+                    candidate = start + way * size
+                    slot_hash, expires, used, _, _ = _SLOT.unpack_from(
+                        self._map, candidate)
+                    if not slot_hash or (expires and expires <= now):
+                        slot = candidate
+                        break
+                    if victim is None or used < victim[0]:
+                        victim = (used, candidate)
+                else:
+                    slot = victim[1]
+                    self.evictions += 1
+            # written empty first so a crash halfway leaves no torn entry
+            _SLOT.pack_into(self._map, slot, 0, 0, 0, 0, 0)
+            body = slot + _SLOT.size
+            self._map[body:body + len(key)] = key
+            self._map[body + len(key):body + len(key) + len(value)] = value
+            _SLOT.pack_into(self._map, slot, key_hash,
+                            now + ttl if ttl is not None else 0, now,
+                            len(key), len(value))
+            return True
+        finally:
+            self._unlock(start, size)
+
+    def delete(self, key, keep=None):
+        """Remove ``key``, except from the slots of the region ``keep``."""
+        key_hash = _hash(key)
+        for region in self._regions:
+            if region is keep:
+                continue
+            start, size = self._group(region, key_hash)
+            self._lock(start, size)
+            try:
+                slot = self._find(start, size, key, key_hash)
+                if slot is not None:
+                    _SLOT.pack_into(self._map, slot, 0, 0, 0, 0, 0)
+            finally:
+                self._unlock(start, size)
+
+    def clear(self):
+        """Remove all entries, in all processes."""
+        end = len(self._map)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, end - _HEADER_SIZE, _HEADER_SIZE)
+        try:
+            for offset, size, groups in self._regions:
+                for slot in range(offset, offset + size * groups * self.ways,
+                                  size):
+                    _SLOT.pack_into(self._map, slot, 0, 0, 0, 0, 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, end - _HEADER_SIZE,
+                        _HEADER_SIZE)
+
+    def stats(self):
+        """Return a dict of the counters of this process."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "rejected": self.rejected,
+        }
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
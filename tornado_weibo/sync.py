@@ -0,0 +1,129 @@
+"""
+Incremental timeline sync.
+
+:class:`TimelineSync` polls a timeline of an access token and only fetches
+the statuses newer than the last poll, using ``since_id`` checkpoints kept
+in a checkpoint store. New statuses are passed to ``on_items`` and/or put
+into a :class:`tornado.queues.Queue`::
+
+    client = WeiboClient(settings)
+    syncer = TimelineSync(client, SQLiteCheckpointStore("sync.db"),
+                          queue=queue)
+    new_statuses = yield syncer.sync(access_token)
+"""
+import sqlite3
+import collections
+from tornado import gen
+
+
+class MemoryCheckpointStore(object):
+    """Keeps the checkpoints in memory."""
+
+    def __init__(self):
+        self._checkpoints = {}
+
+    @gen.coroutine
+    def get(self, access_token, path):
+        raise gen.Return(self._checkpoints.get((access_token, path)))
+
+    @gen.coroutine
+    def set(self, access_token, path, since_id):
+        self._checkpoints[(access_token, path)] = since_id
+
+
+class SQLiteCheckpointStore(object):
+    """Keeps the checkpoints in a SQLite database at ``path``."""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS weibo_checkpoints ("
+                         "access_token TEXT, path TEXT, since_id INTEGER, "
+                         "PRIMARY KEY (access_token, path))")
+        self._db.commit()
+
+    @gen.coroutine
+    def get(self, access_token, path):
+        row = self._db.execute(
+            "SELECT since_id FROM weibo_checkpoints "
+            "WHERE access_token = ? AND path = ?",
+            (access_token, path)).fetchone()
+        raise gen.Return(row[0] if row else None)
+
+    @gen.coroutine
+    def set(self, access_token, path, since_id):
+        self._db.execute(
+            "INSERT OR REPLACE INTO weibo_checkpoints VALUES (?, ?, ?)",
+            (access_token, path, since_id))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class TimelineSync(object):
+    """
+    Fetches the new statuses of timelines.
+
+    ``client`` is anything with the :class:`~tornado_weibo.auth.WeiboMixin`
+    methods, e.g. a :class:`~tornado_weibo.auth.WeiboClient`. At most
+    ``max_pages`` pages of ``count`` statuses are fetched per sync, older
+    new statuses are skipped. The ids of the last ``max_seen_ids`` statuses
+    delivered are remembered so a status is never delivered twice for the
+    same access token. New statuses, newest first, are passed to
+    ``on_items(access_token, path, statuses)`` and put into ``queue`` as
+    ``(access_token, path, statuses)`` tuples.
+    """
+
+    def __init__(self, client, checkpoints=None, on_items=None, queue=None,
+                 count=100, max_pages=5, max_seen_ids=100000):
+        self.client = client
+        self.checkpoints = checkpoints or MemoryCheckpointStore()
+        self.on_items = on_items
+        self.queue = queue
+        self.count = count
+        self.max_pages = max_pages
+        self.max_seen_ids = max_seen_ids
+        self._seen = collections.OrderedDict()
+
+    def _is_new(self, access_token, path, item):
+        key = (access_token, path, item["id"])
+        if key in self._seen:
+            return False
+        self._seen[key] = True
+        if len(self._seen) > self.max_seen_ids:
+            self._seen.popitem(last=False)
+        return True
+
+    @gen.coroutine
+    def sync(self, access_token, path="/statuses/home_timeline", **args):
+        """
+        Fetch the statuses newer than the checkpoint of ``access_token`` and
+        ``path``, returns a :class:`~tornado.concurrent.Future` of the list
+        of new statuses. Anything in the keyword arguments is sent with
+        every request.
+        """
+        since_id = yield self.checkpoints.get(access_token, path)
+        if since_id is not None:
+            args["since_id"] = since_id
+        pager = self.client.weibo_paginate(path, access_token=access_token,
+            count=self.count, max_pages=self.max_pages, background=True,
+            **args)
+        items = []
+        while True:
+            item = yield pager.next()
+            if item is None:
+                break
+            if self._is_new(access_token, path, item):
+                items.append(item)
+        if items:
+            # if a page failed the statuses between the checkpoint and the
+            # failed page are fetched again next time, but not delivered
+            newest = max(int(item["id"]) for item in items)
+            if not pager.failed and (since_id is None or newest > since_id):
+                yield self.checkpoints.set(access_token, path, newest)
+            if self.on_items is not None:
+                self.on_items(access_token, path, items)
+            if self.queue is not None:
+                yield self.queue.put((access_token, path, items))
+        raise gen.Return(items)